@@ -3,10 +3,11 @@
 # ----------------------------------------------------------------------------#
 import sys
 import json
+import base64
 import dateutil.parser
 import babel
-from flask import (Flask, render_template, request,
-                   Response, flash, redirect, url_for)
+from flask import (Flask, render_template, request, abort,
+                   Response, flash, redirect, url_for, jsonify)
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 import logging
@@ -14,7 +15,11 @@ from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
 from flask_migrate import Migrate
+from stats import get_dashboard, refresh_stats
+from entity_cache import EntityCache, make_backend
 from datetime import datetime
+from sqlalchemy import tuple_
+from sqlalchemy.orm.exc import StaleDataError
 # ----------------------------------------------------------------------------#
 # App Config.
 # ----------------------------------------------------------------------------#
@@ -50,6 +55,9 @@ class Venue(db.Model):
     seeking_description = db.Column(db.String(500))
     shows = db.relationship('Show', backref='venue',
                             lazy=True, cascade='all, delete-orphan')
+    # optimistic concurrency: UPDATEs are guarded by and bump the version
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return f'<VENUE [ ID :{self.id}  NAME :{self.name} ] >'
@@ -73,10 +81,25 @@ class Artist(db.Model):
     seeking_venue = db.Column(db.Boolean, default=False)
     seeking_description = db.Column(db.String(500))
     shows = db.relationship('Show', backref='artist', lazy=True)
+    # optimistic concurrency: UPDATEs are guarded by and bump the version
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return f'<Artist ID: {self.id}, name: {self.name}>'
 
+
+def listing_key(column):
+    """a nullable string column of a listing keyset, NULL and '' sorted as
+    one value"""
+    return db.func.coalesce(column, '')
+
+
+# listing page keysets, see paginate_by_cursor
+db.Index('ix_Venue_listing', listing_key(Venue.city), listing_key(Venue.state),
+         listing_key(Venue.name), Venue.id)
+db.Index('ix_Artist_listing', listing_key(Artist.name), Artist.id)
+
 # TODO Implement Show and Artist models, and complete all model relationships and properties, as a database migration.
 
 
@@ -84,15 +107,24 @@ class Show(db.Model):
     __tablename__ = 'Show'
     id = db.Column(db.Integer, primary_key=True)
     artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'),
-                          nullable=False)
+                          nullable=False, index=True)
     venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'),
-                         nullable=False)
-    start_time = db.Column(db.DateTime, default=datetime.today())
+                         nullable=False, index=True)
+    start_time = db.Column(db.DateTime, default=datetime.today(), index=True)
 
     def __repr__(self):
         return f'<SHOW  [id: {self.id} \n venue_id: {self.venue_id} \n artist_id: {self.artist_id} \n start_time: {self.start_time}]>'
 
 
+# ----------------------------------------------------------------------------#
+# Entity cache.
+# ----------------------------------------------------------------------------#
+
+# primary key lookups on the read paths go through here, see entity_cache.py
+entity_cache = EntityCache(make_backend(app.config), db.session,
+                           [Venue, Artist, Show])
+
+
 # ----------------------------------------------------------------------------#
 # Filters.
 # ----------------------------------------------------------------------------#
@@ -109,6 +141,65 @@ def format_datetime(value, format='medium'):
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+# ----------------------------------------------------------------------------#
+# Pagination.
+# ----------------------------------------------------------------------------#
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        abort(400)
+
+
+def valid_cursor(after, columns):
+    """a cursor is the listing keys of a row, strings then an integer id"""
+    if not isinstance(after, list) or len(after) != columns:
+        return False
+    *names, pk = after
+    return (all(isinstance(name, str) and '\x00' not in name
+                for name in names)
+            and type(pk) is int and -2 ** 31 <= pk < 2 ** 31)
+
+
+def paginate_by_cursor(query, sort_columns):
+    """keyset pagination over `sort_columns`
+
+        reads `after` (an opaque cursor) and `per_page` from the request and
+        fetches one extra row to know whether a next page exists, so no
+        OFFSET scan or COUNT(*) is needed.
+
+        `sort_columns` are nullable string columns followed by the primary
+        key. The strings are compared through listing_key, so a NULL never
+        makes the row comparison NULL, and the key breaks ties between
+        equal names.
+
+        Returns:
+            Tuple: (rows of this page, cursor of the next page or None)
+        """
+    per_page = request.args.get('per_page', app.config['PAGE_SIZE'], type=int)
+    per_page = max(1, min(per_page, app.config['MAX_PAGE_SIZE']))
+    *names, pk = sort_columns
+    keys = [listing_key(column) for column in names] + [pk]
+    cursor = request.args.get('after')
+    if cursor:
+        after = decode_cursor(cursor)
+        if not valid_cursor(after, len(keys)):
+            abort(400)
+        query = query.filter(tuple_(*keys) > tuple_(*after))
+    rows = query.order_by(*keys).limit(per_page + 1).all()
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    last = rows[-1]
+    return rows, encode_cursor([getattr(last, column.key) or ''
+                                for column in names] + [getattr(last, pk.key)])
+
 # ----------------------------------------------------------------------------#
 # Controllers.
 # ----------------------------------------------------------------------------#
@@ -124,30 +215,19 @@ def index():
 
 @app.route('/venues')
 def venues():
-    # TODO: replace with real venues data.
-    #       num_shows should be aggregated based on number of upcoming shows per venue.
-
-    def count_future_shows(shows):
-        x = 0
-        for show in shows:
-            if show.start_time > datetime.now():
-                x += 1
-        return x
+    # only the columns the template renders, grouped by city on the fly
+    page, next_cursor = paginate_by_cursor(
+        db.session.query(Venue.id, Venue.name, Venue.city, Venue.state),
+        [Venue.city, Venue.state, Venue.name, Venue.id])
     data = []
-    venues_cities = Venue.query.distinct(Venue.city).all()
-
-    for d_venue in venues_cities:
-        city = d_venue.city
-        venues = Venue.query.filter_by(city=city).all()
-        state = venues[0].state
-        data.append({
-            "city": city,
-            "state": state,
-            "venues": [{"id": venue.id,
-                        "name": venue.name,
-                        "num_upcoming_shows": count_future_shows(venue.shows)} for venue in venues]
-        })
-    return render_template('pages/venues.html', areas=data)
+    for venue in page:
+        # the keyset sorts NULL and '' together, so they are one area
+        city, state = venue.city or '', venue.state or ''
+        if not data or (data[-1]['city'], data[-1]['state']) != (city, state):
+            data.append({"city": city, "state": state, "venues": []})
+        data[-1]['venues'].append({"id": venue.id, "name": venue.name})
+    return render_template('pages/venues.html', areas=data,
+                           next_cursor=next_cursor)
 
 
 @app.route('/venues/search', methods=['POST'])
@@ -170,11 +250,11 @@ def search_venues():
 def show_venue(venue_id):
     # shows the venue page with the given venue_id
     # TODO: replace with real venue data from the venues table, using venue_id
-    venue = Venue.query.get(venue_id)
+    venue = entity_cache.get(Venue, venue_id)
     past_shows = []
     upcoming_shows = []
     for show in venue.shows:
-        artist = Artist.query.get(show.artist_id)
+        artist = entity_cache.get(Artist, show.artist_id)
         show_data = {
             "artist_id": show.artist_id,
             "artist_name": artist.name,
@@ -295,14 +375,14 @@ def delete_venue(venue_id):
 
 @app.route('/artists')
 def artists():
-    # TODO: replace with real data returned from querying the database
-
-    artists = Artist.query.all()
+    page, next_cursor = paginate_by_cursor(
+        db.session.query(Artist.id, Artist.name), [Artist.name, Artist.id])
     data = [{
         "id": artist.id,
         "name": artist.name,
-    } for artist in artists]
-    return render_template('pages/artists.html', artists=data)
+    } for artist in page]
+    return render_template('pages/artists.html', artists=data,
+                           next_cursor=next_cursor)
 
 
 @app.route('/artists/search', methods=['POST'])
@@ -325,11 +405,11 @@ def search_artists():
 def show_artist(artist_id):
     # shows the venue page with the given venue_id
     # TODO: replace with real venue data from the venues table, using venue_id
-    artist = Artist.query.get(artist_id)
+    artist = entity_cache.get(Artist, artist_id)
     past_shows = []
     upcoming_shows = []
     for show in artist.shows:
-        venue = Venue.query.get(show.venue_id)
+        venue = entity_cache.get(Venue, show.venue_id)
         show_data = {
             "venue_id": venue.id,
             "venue_name": venue.name,
@@ -367,8 +447,10 @@ def show_artist(artist_id):
 
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
-    artist = Artist.query.get(artist_id)
-    form = ArtistForm(obj=artist)
+    # from the database: a cached row may carry an older version, which
+    # the submit would then refuse as a conflict
+    artist = Artist.query.get_or_404(artist_id)
+    form = EditArtistForm(obj=artist)
 
     # TODO: populate form with fields from artist with ID <artist_id>
     return render_template('forms/edit_artist.html', form=form, artist=artist)
@@ -379,11 +461,16 @@ def edit_artist_submission(artist_id):
     # TODO: take values from the form submitted, and update existing
     # artist record with ID <artist_id> using the new attributes
     artist = Artist.query.get(artist_id)
-    form = ArtistForm()
+    form = EditArtistForm()
     error = False
+    conflict = False
 
     if form.validate_on_submit():
         try:
+            # the ORM only writes the columns that changed, in an
+            # UPDATE ... WHERE version = <version the editor started from>
+            if form.version.data != artist.version:
+                raise StaleDataError('artist changed since the form was loaded')
             artist.name = form.name.data
             artist.city = form.city.data
             artist.state = form.state.data
@@ -396,13 +483,20 @@ def edit_artist_submission(artist_id):
             artist.facebook_link = form.facebook_link.data
 
             db.session.commit()
+        except StaleDataError:
+            conflict = True
+            db.session.rollback()
         except:
             error = True
             print(sys.exc_info())
             db.session.rollback()
         finally:
             db.session.close()
-            if error:
+            if conflict:
+                flash('Artist ' + request.form['name'] + ' was changed by '
+                      'someone else while you were editing it. Review the '
+                      'latest values and submit your changes again.')
+            elif error:
                 flash(
                     'An error occurred. Artist '
                     + request.form['name']
@@ -411,17 +505,28 @@ def edit_artist_submission(artist_id):
             else:
                 flash('Artist ' +
                       request.form['name'] + ' was successfully listed!')
+    elif form.version.errors:
+        # the edit form always renders the version, so this request did
+        # not come from it
+        abort(400)
     else:
         flash('please fill the fields with the correct format')
         flash(form.errors)
         return render_template('forms/edit_artist.html', form=form, artist=artist)
+    if conflict:
+        artist = Artist.query.get(artist_id)
+        return render_template('forms/edit_artist.html',
+                               form=EditArtistForm(formdata=None, obj=artist),
+                               artist=artist), 409
     return redirect(url_for('show_artist', artist_id=artist_id))
 
 
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
 def edit_venue(venue_id):
-    venue = Venue.query.get(venue_id)
-    form = VenueForm(obj=venue)
+    # from the database: a cached row may carry an older version, which
+    # the submit would then refuse as a conflict
+    venue = Venue.query.get_or_404(venue_id)
+    form = EditVenueForm(obj=venue)
 
     # TODO: populate form with values from venue with ID <venue_id>
     return render_template('forms/edit_venue.html', form=form, venue=venue)
@@ -432,11 +537,16 @@ def edit_venue_submission(venue_id):
     # TODO: take values from the form submitted, and update existing
     # venue record with ID <venue_id> using the new attributes
     venue = Venue.query.get(venue_id)
-    form = VenueForm()
+    form = EditVenueForm()
     error = False
+    conflict = False
 
     if form.validate_on_submit():
         try:
+            # the ORM only writes the columns that changed, in an
+            # UPDATE ... WHERE version = <version the editor started from>
+            if form.version.data != venue.version:
+                raise StaleDataError('venue changed since the form was loaded')
             venue.name = form.name.data
             venue.city = form.city.data
             venue.state = form.state.data
@@ -450,13 +560,20 @@ def edit_venue_submission(venue_id):
             venue.facebook_link = form.facebook_link.data
 
             db.session.commit()
+        except StaleDataError:
+            conflict = True
+            db.session.rollback()
         except:
             error = True
             print(sys.exc_info())
             db.session.rollback()
         finally:
             db.session.close()
-            if error:
+            if conflict:
+                flash('Venue ' + request.form['name'] + ' was changed by '
+                      'someone else while you were editing it. Review the '
+                      'latest values and submit your changes again.')
+            elif error:
                 flash(
                     'An error occurred. Venue '
                     + request.form['name']
@@ -465,10 +582,19 @@ def edit_venue_submission(venue_id):
             else:
                 flash(
                     'Venue ' + request.form['name'] + ' was successfully edited!')
+    elif form.version.errors:
+        # the edit form always renders the version, so this request did
+        # not come from it
+        abort(400)
     else:
         flash('please fill the fields with the correct format')
         flash(form.errors)
         return render_template('forms/edit_venue.html', form=form, venue=venue)
+    if conflict:
+        venue = Venue.query.get(venue_id)
+        return render_template('forms/edit_venue.html',
+                               form=EditVenueForm(formdata=None, obj=venue),
+                               venue=venue), 409
     return redirect(url_for('show_venue', venue_id=venue_id))
 
 #  Create Artist
@@ -536,17 +662,18 @@ def shows():
     #       num_shows should be aggregated based on number of upcoming shows per venue.
 
     data = []
-    shows = Show.query.all()
+    # upcoming shows only, read through the start_time index
+    shows = Show.query.filter(Show.start_time > datetime.now()).order_by(
+        Show.start_time).all()
     for show in shows:
-        if show.start_time > datetime.now():
-            venue = Venue.query.get(show.venue_id)
-            artist = Artist.query.get(show.artist_id)
-            data.append({"venue_id": show.venue_id,
-                         "venue_name": venue.name,
-                         "artist_id": show.artist_id,
-                         "artist_name": artist.name,
-                         "artist_image_link": artist.image_link,
-                         "start_time": str(show.start_time)})
+        venue = entity_cache.get(Venue, show.venue_id)
+        artist = entity_cache.get(Artist, show.artist_id)
+        data.append({"venue_id": show.venue_id,
+                     "venue_name": venue.name,
+                     "artist_id": show.artist_id,
+                     "artist_name": artist.name,
+                     "artist_image_link": artist.image_link,
+                     "start_time": str(show.start_time)})
     return render_template('pages/shows.html', shows=data)
 
 
@@ -591,6 +718,38 @@ def create_show_submission():
     return redirect(url_for('index'))
 
 
+#  Dashboard
+#  ----------------------------------------------------------------
+
+@app.route('/dashboard')
+def dashboard():
+    # every widget reads a precomputed relation, see stats.py
+    return render_template('pages/dashboard.html',
+                           widgets=get_dashboard(
+                               db.engine, app.config['DASHBOARD_ROWS']))
+
+
+@app.route('/dashboard/stats')
+def dashboard_stats():
+    limit = request.args.get('limit', app.config['DASHBOARD_ROWS'], type=int)
+    limit = max(1, min(limit, app.config['MAX_DASHBOARD_ROWS']))
+    widgets = get_dashboard(db.engine, limit)
+    for widget in widgets.values():
+        if widget['refreshed_at'] is not None:
+            widget['refreshed_at'] = widget['refreshed_at'].isoformat()
+        for row in widget['rows']:
+            if 'week_start' in row:
+                row['week_start'] = str(row['week_start'])
+    return jsonify(widgets)
+
+
+@app.cli.command('refresh-stats')
+def refresh_stats_command():
+    """Rebuild the dashboard statistics without blocking readers."""
+    for name, refreshed_at in refresh_stats(db.engine).items():
+        print(f'{name} refreshed at {refreshed_at}')
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
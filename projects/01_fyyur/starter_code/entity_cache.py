@@ -0,0 +1,172 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+# ----------------------------------------------------------------------------#
+# Second-level entity cache.
+#
+# Rows are cached by primary key as plain column dicts, so they outlive the
+# request session, and are merged back into the current session without a
+# query. Every flush that touches a cached model drops the affected keys.
+# ----------------------------------------------------------------------------#
+
+
+class LRUCache:
+    """in-process cache, evicts the least recently used key past `maxsize`"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileCache:
+    """cache shared by every worker process on the host through a local
+    sqlite file, so an invalidation in one worker is seen by all of them"""
+
+    def __init__(self, path, ttl=300):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entity_cache ('
+                         'key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def _connect(self):
+        # connections must not cross a fork into the worker processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = sqlite3.connect(self.path, timeout=5)
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM entity_cache WHERE key = ? AND expires >= ?',
+            (key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, value):
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO entity_cache VALUES (?, ?, ?)',
+                (key, pickle.dumps(value), time.time() + self.ttl))
+
+    def delete(self, *keys):
+        with self._connect() as conn:
+            conn.executemany('DELETE FROM entity_cache WHERE key = ?',
+                             [(key,) for key in keys])
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM entity_cache')
+
+
+def make_backend(config):
+    """builds the backend named by ENTITY_CACHE in the app config"""
+    ttl = config.get('ENTITY_CACHE_TTL', 300)
+    if config.get('ENTITY_CACHE') == 'file':
+        return FileCache(config['ENTITY_CACHE_PATH'], ttl=ttl)
+    return LRUCache(config.get('ENTITY_CACHE_SIZE', 1024), ttl=ttl)
+
+
+class EntityCache:
+    """primary key lookups for `models` served from `backend`
+
+        Args:
+            backend : LRUCache, FileCache or anything with get/set/delete
+            session : the (scoped) session to read through and watch
+            models : mapped classes to cache
+        """
+
+    def __init__(self, backend, session, models):
+        self.backend = backend
+        self.session = session
+        self.tables = {model.__tablename__ for model in models}
+        event.listen(session, 'after_flush', self._after_flush)
+        event.listen(session, 'after_commit', self._after_commit)
+        event.listen(session, 'after_soft_rollback', self._after_rollback)
+
+    @staticmethod
+    def key(model, pk):
+        return f'{model.__tablename__}:{pk}'
+
+    def get(self, model, pk):
+        """returns the `model` row with primary key `pk`, or None"""
+        if pk is None:
+            return None
+        state = self.backend.get(self.key(model, pk))
+        if state is None:
+            instance = self.session.query(model).get(pk)
+            if instance is not None:
+                self.backend.set(self.key(model, pk), {
+                    attr.key: getattr(instance, attr.key)
+                    for attr in inspect(model).column_attrs})
+            return instance
+        instance = model(**state)
+        make_transient_to_detached(instance)
+        return self.session.merge(instance, load=False)
+
+    def invalidate(self, model, pk):
+        self.backend.delete(self.key(model, pk))
+
+    def _changed_keys(self, session):
+        # new rows cannot be cached yet, so only updates and deletes count
+        for instance in session.dirty | session.deleted:
+            table = getattr(instance, '__tablename__', None)
+            identity = inspect(instance).identity
+            if table in self.tables and identity:
+                yield f'{table}:{identity[0]}'
+
+    def _after_flush(self, session, flush_context):
+        keys = set(self._changed_keys(session))
+        if keys:
+            self.backend.delete(*keys)
+            # a concurrent reader may cache the pre-commit row in between
+            session.info.setdefault('entity_cache_keys', set()).update(keys)
+
+    def _after_commit(self, session):
+        keys = session.info.pop('entity_cache_keys', None)
+        if keys:
+            self.backend.delete(*keys)
+
+    def _after_rollback(self, session, previous_transaction):
+        # the session may have read its own flushed rows back into the
+        # cache before rolling them back
+        keys = session.info.pop('entity_cache_keys', None)
+        if keys:
+            self.backend.delete(*keys)
@@ -1,7 +1,8 @@
 from datetime import datetime
 from flask_wtf import FlaskForm
-from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField
+from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField, IntegerField
 from wtforms.validators import DataRequired, AnyOf, URL, Regexp
+from wtforms.widgets import HiddenInput
 
 
 class ShowForm(FlaskForm):
@@ -132,6 +133,13 @@ class VenueForm(FlaskForm):
     )
 
 
+class EditVenueForm(VenueForm):
+    # row version the form was rendered from, checked on submit
+    version = IntegerField(
+        'version', widget=HiddenInput(), validators=[DataRequired()]
+    )
+
+
 class ArtistForm(FlaskForm):
     name = StringField(
         'name', validators=[DataRequired()]
@@ -242,4 +250,11 @@ class ArtistForm(FlaskForm):
         'website', validators=[URL()]
     )
 
+
+class EditArtistForm(ArtistForm):
+    # row version the form was rendered from, checked on submit
+    version = IntegerField(
+        'version', widget=HiddenInput(), validators=[DataRequired()]
+    )
+
 # TODO IMPLEMENT NEW ARTIST FORM AND NEW SHOW FORM
@@ -0,0 +1,68 @@
+"""dashboard statistics relations
+
+Revision ID: 3b9f2c71d4a8
+Revises: e757948194ad
+Create Date: 2026-10-19 10:30:12.412087
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9f2c71d4a8'
+down_revision = 'e757948194ad'
+branch_labels = None
+depends_on = None
+
+WIDGETS = ['top_venues', 'busiest_cities', 'seeking_genres', 'shows_per_week']
+
+# REFRESH ... CONCURRENTLY needs a plain unique index on every view
+MATERIALIZED_VIEWS = [
+    ('stats_top_venues', 'venue_id', '''
+        SELECT v.id AS venue_id, v.name AS venue_name, v.city, v.state,
+               COUNT(s.id) AS upcoming_shows
+        FROM "Venue" v JOIN "Show" s ON s.venue_id = v.id
+        WHERE s.start_time > now()
+        GROUP BY v.id, v.name, v.city, v.state'''),
+    ('stats_busiest_cities', 'city, state', '''
+        SELECT COALESCE(v.city, '') AS city, COALESCE(v.state, '') AS state,
+               COUNT(DISTINCT v.id) AS venues, COUNT(s.id) AS upcoming_shows
+        FROM "Venue" v LEFT JOIN "Show" s
+             ON s.venue_id = v.id AND s.start_time > now()
+        GROUP BY 1, 2'''),
+    ('stats_seeking_genres', 'genre', '''
+        SELECT g.genre, COUNT(DISTINCT a.id) AS artists
+        FROM "Artist" a, unnest(a.genres) AS g(genre)
+        WHERE a.seeking_venue
+        GROUP BY g.genre'''),
+    ('stats_shows_per_week', 'week_start', '''
+        SELECT date_trunc('week', start_time)::date AS week_start,
+               COUNT(id) AS shows
+        FROM "Show" WHERE start_time IS NOT NULL
+        GROUP BY 1'''),
+]
+
+
+def upgrade():
+    op.create_table('stats_refresh',
+    sa.Column('widget', sa.String(length=50), nullable=False),
+    sa.Column('refreshed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('widget')
+    )
+    # materialized views and unnest() need PostgreSQL, like the ARRAY
+    # genre columns they read
+    for name, key, query in MATERIALIZED_VIEWS:
+        op.execute(f'CREATE MATERIALIZED VIEW {name} AS {query}')
+        op.execute(f'CREATE UNIQUE INDEX {name}_key ON {name} ({key})')
+    stats_refresh = sa.table('stats_refresh',
+                             sa.column('widget', sa.String),
+                             sa.column('refreshed_at', sa.DateTime))
+    op.execute(stats_refresh.insert().values(
+        [{'widget': w, 'refreshed_at': sa.func.now()} for w in WIDGETS]))
+
+
+def downgrade():
+    for name, _, _ in reversed(MATERIALIZED_VIEWS):
+        op.execute(f'DROP MATERIALIZED VIEW {name}')
+    op.drop_table('stats_refresh')
@@ -0,0 +1,33 @@
+"""listing keysets that sort NULL names as ''
+
+Revision ID: d2b8e4f1a6c9
+Revises: c7e3a9f05b21
+Create Date: 2026-10-19 15:20:41.503318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2b8e4f1a6c9'
+down_revision = 'c7e3a9f05b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index('ix_Artist_name_id', table_name='Artist')
+    op.drop_index('ix_Venue_city_state_name_id', table_name='Venue')
+    op.create_index('ix_Venue_listing', 'Venue', [
+        sa.text("coalesce(city, '')"), sa.text("coalesce(state, '')"),
+        sa.text("coalesce(name, '')"), 'id'], unique=False)
+    op.create_index('ix_Artist_listing', 'Artist', [
+        sa.text("coalesce(name, '')"), 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_Artist_listing', table_name='Artist')
+    op.drop_index('ix_Venue_listing', table_name='Venue')
+    op.create_index('ix_Venue_city_state_name_id', 'Venue', ['city', 'state', 'name', 'id'], unique=False)
+    op.create_index('ix_Artist_name_id', 'Artist', ['name', 'id'], unique=False)
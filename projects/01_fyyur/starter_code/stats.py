@@ -0,0 +1,88 @@
+from datetime import datetime
+from sqlalchemy import DateTime, text
+
+# ----------------------------------------------------------------------------#
+# Dashboard statistics.
+#
+# Every widget is read from its own precomputed relation instead of scanning
+# Venue / Artist / Show on each request. The relations are PostgreSQL
+# materialized views (see the stats migration) refreshed CONCURRENTLY, so
+# readers keep seeing the previous snapshot while a refresh runs.
+# ----------------------------------------------------------------------------#
+
+WIDGETS = {
+    'top_venues': {
+        'title': 'Top venues by upcoming shows',
+        'relation': 'stats_top_venues',
+        'order_by': 'upcoming_shows DESC, venue_name',
+    },
+    'busiest_cities': {
+        'title': 'Busiest cities',
+        'relation': 'stats_busiest_cities',
+        'order_by': 'upcoming_shows DESC, venues DESC, city',
+    },
+    'seeking_genres': {
+        'title': 'Artists seeking venues per genre',
+        'relation': 'stats_seeking_genres',
+        'order_by': 'artists DESC, genre',
+    },
+    'shows_per_week': {
+        'title': 'Shows per week',
+        'relation': 'stats_shows_per_week',
+        'order_by': 'week_start DESC',
+    },
+}
+
+
+def refresh_stats(engine, names=None):
+    """rebuilds the dashboard relations
+
+        Args:
+            engine : sqlalchemy engine
+            names : widget names to refresh, all widgets when None
+
+        Returns:
+            Dict: widget name -> refresh time
+        """
+    refreshed = {}
+    for name in names or WIDGETS:
+        # one transaction per widget so a slow view never holds the others
+        with engine.begin() as conn:
+            conn.execute(text(
+                'REFRESH MATERIALIZED VIEW CONCURRENTLY '
+                + WIDGETS[name]['relation']))
+            refreshed_at = datetime.now()
+            conn.execute(
+                text('UPDATE stats_refresh SET refreshed_at = :at '
+                     'WHERE widget = :widget'),
+                {'at': refreshed_at, 'widget': name})
+        refreshed[name] = refreshed_at
+    return refreshed
+
+
+def get_dashboard(engine, limit=10):
+    """reads every widget from its precomputed relation
+
+        Args:
+            engine : sqlalchemy engine
+            limit : maximum rows per widget
+
+        Returns:
+            Dict: widget name -> title, refreshed_at and rows
+        """
+    with engine.connect() as conn:
+        refreshed = dict(conn.execute(
+            text('SELECT widget, refreshed_at FROM stats_refresh')
+            .columns(refreshed_at=DateTime)).fetchall())
+        dashboard = {}
+        for name, widget in WIDGETS.items():
+            rows = conn.execute(
+                text(f'SELECT * FROM {widget["relation"]} '
+                     f'ORDER BY {widget["order_by"]} LIMIT :limit'),
+                {'limit': limit})
+            dashboard[name] = {
+                'title': widget['title'],
+                'refreshed_at': refreshed.get(name),
+                'rows': [dict(row) for row in rows],
+            }
+    return dashboard
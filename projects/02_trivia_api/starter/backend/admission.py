@@ -0,0 +1,130 @@
+import math
+import threading
+from flask import g, jsonify, request
+
+# endpoint -> (requests served at once, requests allowed to wait). Slow
+# endpoints get few slots so they cannot take every worker thread; the
+# ones not listed (/categories, creating and deleting a question) are
+# cheap and always admitted at once.
+DEFAULT_LIMITS = {
+    'get_questions': (32, 64),
+    'get_category_questions': (32, 64),
+    'search_questions': (8, 16),
+    'get_similar_questions': (8, 16),
+    'play_quiz': (16, 32),
+    'next_quiz_question': (16, 32),
+    'export_question_bank': (2, 0),
+    'import_question_bank': (1, 0),
+}
+# longest wait in a queue, in seconds, before the request is shed
+QUEUE_TIMEOUT = 2.0
+
+'''
+EndpointLimit
+    concurrency slots of one endpoint and a bounded queue in front of
+    them. A request that finds the queue full, or waits longer than
+    `timeout`, is rejected instead of tying up a worker.
+'''
+
+
+class EndpointLimit:
+
+    def __init__(self, concurrency, queue, timeout=QUEUE_TIMEOUT):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """takes a slot, waiting in the queue if there is room
+
+            Returns:
+                Boolean: False when the request was rejected
+            """
+        with self.condition:
+            if self.active < self.concurrency and not self.waiting:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                admitted = self.condition.wait_for(
+                    lambda: self.active < self.concurrency, self.timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.rejected += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def retry_after(self):
+        """seconds a rejected client should wait, at least 1"""
+        return max(1, math.ceil(self.timeout))
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'queue': self.queue,
+            'active': self.active,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+        }
+
+
+'''
+AdmissionControl
+    per-endpoint limits of one worker process, applied before each
+    request's view runs. Rejected requests get a 503 with Retry-After.
+'''
+
+
+class AdmissionControl:
+
+    def __init__(self, limits=None, timeout=QUEUE_TIMEOUT):
+        limits = DEFAULT_LIMITS if limits is None else limits
+        self.limits = {endpoint: EndpointLimit(concurrency, queue, timeout)
+                       for endpoint, (concurrency, queue) in limits.items()}
+
+    def init_app(self, app):
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def admit(self):
+        limit = self.limits.get(request.endpoint)
+        if limit is None:
+            return None
+        if not limit.acquire():
+            response = jsonify({
+                'success': False,
+                'error': 503,
+                'message': 'service unavailable'
+            })
+            response.status_code = 503
+            response.headers['Retry-After'] = str(limit.retry_after())
+            return response
+        g.admitted = limit
+        return None
+
+    def release(self, exc=None):
+        limit = g.pop('admitted', None)
+        if limit is not None:
+            limit.release()
+
+    def stats(self):
+        """
+            Returns:
+                Dict: endpoint -> slots, queue depth and rejections so far
+            """
+        return {endpoint: limit.stats()
+                for endpoint, limit in self.limits.items()}
@@ -0,0 +1,479 @@
+"""The read paths of the trivia API as an ASGI application, for many
+concurrent clients such as quiz events with thousands of players.
+
+Serves only the endpoints those clients hit:
+
+    GET  /categories
+    GET  /questions
+    GET  /categories/<id>/questions
+    POST /questions/search
+    GET  /stats
+    POST /quizzes
+    POST /quizzes/<session id>/next
+
+with the same JSON bodies, status codes and headers as flaskr.create_app,
+but requests wait on PostgreSQL without holding a thread: queries go
+through an asyncpg connection pool. Writes and every other route stay
+with the Flask app. The page SQL, search SQL, quiz logic and buckets,
+version stamps and page cache are the ones the Flask app uses, so both
+serve the same database side by side and honour each other's ETags.
+
+    pip install asyncpg uvicorn
+    uvicorn asgi:create_asgi_app --factory --workers 4
+"""
+import json
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+from werkzeug.http import parse_accept_header, parse_etags
+
+try:
+    import asyncpg
+except ImportError:  # optional, pip install asyncpg
+    asyncpg = None
+
+from models import database_path
+from quiz import (QuestionSampler, parse_quiz, quiz_steps,
+                  next_in_session_steps)
+from cache import VersionStamps, PageCache, json_with_fragments
+from search import PostgresSearch
+from encoding import dumps, encodings, compress, COMPRESS_MIN_SIZE
+from stats import question_stats
+from flaskr import QUESTIONS_PER_PAGE, page_statement
+
+POOL_SIZE = int(os.getenv('TRIVIA_POOL_SIZE', 20))
+# seconds before the category map is re-read, as in cache.CategoryCache
+CATEGORY_MAX_AGE = 300
+HTML = 'text/html; charset=utf-8'
+NAMED_PARAMETER = re.compile(r'(?<!:):(\w+)')
+ERRORS = {
+    400: 'bad request',
+    404: 'resource not found',
+    405: 'method not allowed',
+    422: 'unprocessable',
+    500: 'internal server error',
+}
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+    (b'access-control-allow-methods', b'GET,PUT,POST,DELETE,OPTIONS'),
+]
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def positional(sql, params):
+    """rewrites :named parameters as asyncpg's $1, $2, ...
+
+        Returns:
+            Tuple: (SQL, list of argument values)
+        """
+    names = []
+
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f'${names.index(match.group(1)) + 1}'
+
+    sql = NAMED_PARAMETER.sub(number, sql)
+    return sql, [params[name] for name in names]
+
+
+def optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+
+'''
+Request
+    what the handlers need of an ASGI HTTP scope: method, path, query
+    arguments and headers. The JSON body is read on demand by `json()`.
+'''
+
+
+class Request:
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self.args = {key: values[0] for key, values in
+                     parse_qs(self.query_string).items()}
+        self.headers = {key.decode('latin-1').lower(): value.decode('latin-1')
+                        for key, value in scope.get('headers', [])}
+        self.more_body = True
+
+    @property
+    def full_path(self):
+        return f'{self.path}?{self.query_string}'
+
+    def arg(self, name, default=None):
+        """integer query argument, `default` when missing or malformed"""
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+    def if_none_match(self, etag):
+        return parse_etags(self.headers.get('if-none-match')).contains_weak(
+            etag)
+
+    async def chunks(self):
+        while self.more_body:
+            message = await self.receive()
+            self.more_body = message.get('more_body', False)
+            yield message.get('body', b'')
+
+    async def json(self):
+        """the JSON body, None unless sent as application/json"""
+        body = b''.join([chunk async for chunk in self.chunks()])
+        mimetype = self.headers.get('content-type', '').split(';')[0].strip()
+        if mimetype != 'application/json' and not (
+                mimetype.startswith('application/') and
+                mimetype.endswith('+json')):
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise HTTPError(400)
+
+'''
+Response
+    a JSON (or any other bytes) response
+'''
+
+
+class Response:
+
+    def __init__(self, body=b'', status=200, mimetype='application/json'):
+        self.body = body.encode() if isinstance(body, str) else body
+        self.status = status
+        self.headers = [(b'content-type', mimetype.encode())]
+        self.etag = None
+
+    @classmethod
+    def json(cls, payload, status=200):
+        return cls(dumps(payload), status)
+
+    def set_etag(self, etag):
+        self.etag = etag
+
+    async def send(self, send, accept_encoding, head=False,
+                   min_size=COMPRESS_MIN_SIZE):
+        """sends the response; for a HEAD request only its headers, which
+        describe the body a GET would get"""
+        headers = self.headers + CORS_HEADERS + [(b'vary', b'Accept-Encoding')]
+        body, weak = self.body, False
+        coding = parse_accept_header(accept_encoding).best_match(encodings())
+        if (200 <= self.status < 300 and self.status != 204 and
+                coding is not None and len(body) >= min_size):
+            body = compress(body, coding)
+            headers.append((b'content-encoding', coding.encode()))
+            weak = True
+        if self.etag is not None:
+            etag = f'"{self.etag}"'
+            headers.append((b'etag', (f'W/{etag}' if weak else etag).encode()))
+        headers.append((b'content-length', str(len(body)).encode()))
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': headers})
+        await send({'type': 'http.response.body',
+                    'body': b'' if head else body})
+
+
+def error(status):
+    return Response.json({
+        'success': False,
+        'error': status,
+        'message': ERRORS[status]
+    }, status)
+
+
+def route(method, pattern):
+    def register(handler):
+        handler.route = (method, re.compile(pattern + '$'))
+        return handler
+    return register
+
+
+'''
+TriviaApp
+    the ASGI application. The pool is opened on lifespan startup, or on
+    the first request under servers without lifespan support.
+'''
+
+
+class TriviaApp:
+
+    def __init__(self, database_url=database_path, pool_size=POOL_SIZE,
+                 stamps_path=None, page_cache_size=256):
+        if asyncpg is None:
+            raise RuntimeError('the ASGI app needs asyncpg, '
+                               'pip install asyncpg')
+        self.database_url = database_url
+        self.pool_size = pool_size
+        self.pool = None
+        self.search = PostgresSearch()
+        self.stamps = VersionStamps.for_database(database_url, stamps_path)
+        self.sampler = QuestionSampler(self.stamps)
+        self.page_cache = PageCache(page_cache_size)
+        self.categories = None
+        handlers = [getattr(self, name) for name in dir(type(self))]
+        self.routes = {handler.route: handler for handler in handlers
+                       if hasattr(handler, 'route')}
+
+    async def startup(self):
+        if self.pool is not None:
+            return
+        # asyncpg takes plain postgresql:// URLs, no SQLAlchemy driver name
+        dsn = re.sub(r'^postgresql\+\w+://', 'postgresql://',
+                     self.database_url)
+        self.pool = await asyncpg.create_pool(
+            dsn, min_size=min(2, self.pool_size), max_size=self.pool_size)
+        has_vector = await self.pool.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = 'questions' AND column_name = 'search_vector')")
+        self.search.vector = ('search_vector' if has_vector
+                              else PostgresSearch.VECTOR)
+
+    async def shutdown(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await self.startup()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await self.shutdown()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        await self.startup()
+        request = Request(scope, receive)
+        try:
+            response = await self.dispatch(request)
+        except HTTPError as err:
+            response = error(err.status)
+        await response.send(send, request.headers.get('accept-encoding'),
+                            head=request.method == 'HEAD')
+
+    async def dispatch(self, request):
+        allowed = set()
+        for (method, pattern), handler in self.routes.items():
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            allowed.add(method)
+            if method == request.method or (
+                    method == 'GET' and request.method == 'HEAD'):
+                return await handler(request, *match.groups())
+        if not allowed:
+            raise HTTPError(404)
+        if request.method == 'OPTIONS':
+            # CORS preflight
+            return Response(mimetype=HTML)
+        raise HTTPError(405)
+
+    async def category_map(self):
+        """
+            Returns:
+                Tuple: ({id: type} dict, the dict serialized as JSON),
+                cached like cache.CategoryCache
+            """
+        version = self.stamps.get('categories')
+        entry = self.categories
+        if (entry is None or entry[0] != version or
+                time.monotonic() - entry[3] > CATEGORY_MAX_AGE):
+            rows = await self.pool.fetch('SELECT id, type FROM categories')
+            categories = {row['id']: row['type'] for row in rows}
+            entry = (version, categories, dumps(categories), time.monotonic())
+            self.categories = entry
+        return entry[1:3]
+
+    async def versioned_page(self, request, etag, build):
+        """like create_app's versioned_page, with an async `build()`"""
+        if request.if_none_match(etag):
+            response = Response(status=304, mimetype=HTML)
+        else:
+            key = (etag, request.full_path)
+            body = self.page_cache.get(key)
+            if body is not None:
+                response = Response(body)
+            else:
+                response = await build()
+                if response.status != 200:
+                    return response
+                self.page_cache.set(key, response.body)
+        response.set_etag(etag)
+        return response
+
+    async def paginate_questions(self, request, category=None):
+        """paginate_questions of flaskr, over the same SQL: page or
+        `?after=<id>` keyset seek, plus the total"""
+        after = request.arg('after')
+        params = {'category': category, 'after': after, 'offset': 0}
+        if after is None:
+            params['offset'] = (max(request.arg('page', 1), 1) - 1) * \
+                QUESTIONS_PER_PAGE
+        page, total = page_statement(category is not None, after is not None,
+                                     False)
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(*self.statement(page, params))
+            count = await conn.fetchval(*self.statement(total, params))
+        return [dict(row) for row in rows], count
+
+    @staticmethod
+    def statement(clause, params):
+        """a text() clause of flaskr as asyncpg arguments"""
+        sql, args = positional(clause.text, params)
+        return (sql, *args)
+
+    @route('GET', '/categories')
+    async def get_categories(self, request):
+        etag = self.stamps.etag('categories', 'categories')
+        if request.if_none_match(etag):
+            response = Response(status=304, mimetype=HTML)
+        else:
+            _, cats_json = await self.category_map()
+            response = Response(json_with_fragments(
+                {'success': True}, categories=cats_json))
+        response.set_etag(etag)
+        return response
+
+    @route('GET', '/questions')
+    async def get_questions(self, request):
+        async def build():
+            questions, total_questions = await self.paginate_questions(
+                request)
+            if len(questions) == 0:
+                raise HTTPError(404)
+            _, cats_json = await self.category_map()
+            return Response(json_with_fragments({
+                'success': True,
+                'questions': questions,
+                'total_questions': total_questions,
+                'current_category': None
+            }, categories=cats_json))
+
+        return await self.versioned_page(request, self.stamps.etag(
+            'questions', 'questions', 'categories'), build)
+
+    @route('POST', '/questions/search')
+    async def search_questions(self, request):
+        body = await request.json()
+        try:
+            term = (body.get('searchTerm') or '').strip()
+            category = optional_int(body.get('category'))
+            difficulty = optional_int(body.get('difficulty'))
+        except (AttributeError, TypeError, ValueError):
+            raise HTTPError(400)
+        page = max(request.arg('page', 1), 1)
+
+        async def search(page, per_page):
+            sql, args = positional(*self.search.statement(
+                term, category, difficulty, page, per_page))
+            return await self.pool.fetch(sql, *args)
+
+        rows = await search(page, QUESTIONS_PER_PAGE)
+        if rows:
+            total_questions = rows[0]['total']
+        elif page > 1:
+            rows_of_first = await search(1, 1)
+            total_questions = rows_of_first[0]['total'] if rows_of_first else 0
+        else:
+            total_questions = 0
+        return Response.json({
+            'success': True,
+            'questions': [self.search.format(row) for row in rows],
+            'total_questions': total_questions,
+            'current_category': category
+        })
+
+    @route('GET', r'/categories/(\d+)/questions')
+    async def get_category_questions(self, request, category_id):
+        category_id = int(category_id)
+
+        async def build():
+            questions, total_questions = await self.paginate_questions(
+                request, category_id)
+            return Response.json({
+                'success': True,
+                'questions': questions,
+                'total_questions': total_questions,
+                'current_category': category_id
+            })
+
+        return await self.versioned_page(request, self.stamps.etag(
+            f'category-{category_id}', f'questions:{category_id}'), build)
+
+    @route('GET', '/stats')
+    async def get_stats(self, request):
+        async def build():
+            rows = await self.pool.fetch(
+                'SELECT category, difficulty, count FROM question_counts')
+            categories, _ = await self.category_map()
+            return Response.json(dict(question_stats(
+                {(row['category'], row['difficulty']): row['count']
+                 for row in rows}, categories), success=True))
+
+        return await self.versioned_page(request, self.stamps.etag(
+            'stats', 'questions', 'categories'), build)
+
+    async def run(self, steps):
+        """runs quiz steps on a pooled connection, in one transaction,
+        like quiz.run_steps"""
+        result = None
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                while True:
+                    try:
+                        kind, sql, params = steps.send(result)
+                    except StopIteration as done:
+                        return done.value
+                    sql, args = positional(sql, params)
+                    if kind == 'all':
+                        result = await conn.fetch(sql, *args)
+                    elif kind == 'row':
+                        result = await conn.fetchrow(sql, *args)
+                    else:
+                        # the command tag, e.g. "UPDATE 1"
+                        status = await conn.execute(sql, *args)
+                        result = int(status.rsplit(' ', 1)[-1])
+
+    @route('POST', '/quizzes')
+    async def play_quiz(self, request):
+        try:
+            quiz = parse_quiz(await request.json())
+        except ValueError:
+            raise HTTPError(400)
+        return Response.json(await self.run(quiz_steps(self.sampler, quiz)))
+
+    @route('POST', r'/quizzes/([^/]+)/next')
+    async def next_quiz_question(self, request, session_id):
+        payload = await self.run(next_in_session_steps(session_id))
+        if payload is None:
+            raise HTTPError(404)
+        return Response.json(payload)
+
+
+def create_asgi_app(database_url=None, **options):
+    """the app factory, for `uvicorn asgi:create_asgi_app --factory`: the
+    stamps file and the pool belong to the worker that builds the app, not
+    to whatever process imports this module"""
+    return TriviaApp(
+        database_url or os.getenv('TRIVIA_DATABASE_URL', database_path),
+        **options)
+
@@ -0,0 +1,202 @@
+"""Compares the WSGI (flaskr) and ASGI (asgi.py) servers at high concurrency.
+
+Both apps are served from subprocesses against the same synthetic question
+bank and the same pool size: the Flask app by werkzeug's threaded server,
+one thread per connection, and the ASGI app by uvicorn. An asyncio client
+keeps --concurrency keep-alive connections busy per endpoint and reports
+throughput, p50/p99 latency and errors (timeouts, resets, 5xx):
+
+    pip install asyncpg uvicorn
+    python benchmarks/bench_asgi.py --size 100000 \\
+        --concurrency 64 256 1024 --output asgi.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from flaskr import create_app  # noqa: E402
+from dataset import seed  # noqa: E402
+from harness import endpoints, percentile, database_path  # noqa: E402
+
+POOL_SIZE = 20
+SERVERS = ('wsgi', 'asgi')
+
+
+def serve(kind, port, database, pool_size):
+    """runs one server in this process until killed"""
+    if kind == 'wsgi':
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class RequestHandler(WSGIRequestHandler):
+            # keep-alive and no access log, like the ASGI server
+            protocol_version = 'HTTP/1.1'
+
+            def log_request(self, *args):
+                pass
+
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': database,
+            'SQLALCHEMY_ENGINE_OPTIONS': {'pool_size': pool_size,
+                                          'max_overflow': 0}})
+        make_server('127.0.0.1', port, app, threaded=True,
+                    request_handler=RequestHandler).serve_forever()
+    else:
+        import uvicorn
+        from asgi import create_asgi_app
+        uvicorn.run(create_asgi_app(database, pool_size=pool_size),
+                    host='127.0.0.1', port=port, log_level='warning',
+                    backlog=4096)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(kind, database, pool_size):
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), '--serve', kind,
+        '--port', str(port), '--database', database,
+        '--pool-size', str(pool_size)])
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'{kind} server did not start')
+
+
+async def exchange(reader, writer, method, url, body):
+    """sends one request and reads the response
+
+        Returns:
+            Tuple: (status code, whether the connection stays open)
+        """
+    data = json.dumps(body).encode() if body is not None else b''
+    writer.write(
+        f'{method} {url} HTTP/1.1\r\nHost: localhost\r\n'
+        f'Content-Type: application/json\r\n'
+        f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = dict(line.lower().split(': ', 1) for line in lines[1:] if line)
+    await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers.get('connection') != 'close'
+
+
+async def drive(port, make_request, requests, concurrency, timeout):
+    """sends `requests` requests over `concurrency` connections"""
+    latencies, errors = [], 0
+    remaining = requests
+
+    async def connection():
+        nonlocal remaining, errors
+        reader = writer = None
+        while remaining > 0:
+            remaining -= 1
+            method, url, body = make_request()
+            start = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(
+                        '127.0.0.1', port, limit=2 ** 22)
+                status, keep = await asyncio.wait_for(
+                    exchange(reader, writer, method, url, body), timeout)
+            except (OSError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError):
+                status, keep = 599, False
+            latencies.append(time.perf_counter() - start)
+            if status >= 500:
+                errors += 1
+            if not keep and writer is not None:
+                writer.close()
+                reader = writer = None
+        if writer is not None:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connection() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'throughput_rps': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[64, 256, 1024])
+    parser.add_argument('--requests', type=int, default=4000,
+                        help='requests per endpoint, server and concurrency')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--database', default=database_path)
+    parser.add_argument('--servers', nargs='+', default=SERVERS,
+                        choices=SERVERS)
+    parser.add_argument('--output', help='JSON file, stdout by default')
+    parser.add_argument('--serve', choices=SERVERS, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port, args.database, args.pool_size)
+        return
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    with app.app_context():
+        seed(args.size)
+    random.seed(0)
+    results = []
+    for kind in args.servers:
+        process, port = start_server(kind, args.database, args.pool_size)
+        try:
+            for name, make_request in endpoints(args.size).items():
+                asyncio.run(drive(port, make_request, 50, 1, args.timeout))
+                for concurrency in args.concurrency:
+                    result = asyncio.run(drive(
+                        port, make_request, args.requests, concurrency,
+                        args.timeout))
+                    result.update(server=kind, endpoint=name)
+                    results.append(result)
+                    print(f'{kind} {name:32} c={concurrency:<5} '
+                          f'{result["throughput_rps"]:8.1f} rps '
+                          f'p50 {result["p50_ms"]:8.2f} ms '
+                          f'p99 {result["p99_ms"]:9.2f} ms '
+                          f'errors {result["errors"]}', file=sys.stderr)
+        finally:
+            process.terminate()
+            process.wait()
+
+    report = {'dataset': args.size, 'pool_size': args.pool_size,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Compares serializers and response compression for /questions pages.
+
+Reports, per page size, the CPU time to serialize a page of questions with
+the standard json module and with orjson (when installed), and the bytes
+sent on the wire for identity, gzip and brotli (when installed) encodings.
+Uses the trivia_bench database seeded by bench_pagination.py.
+
+    python benchmarks/bench_encoding.py --repeat 200
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import encoding  # noqa: E402
+from encoding import FastJSONEncoder  # noqa: E402
+from flaskr import create_app  # noqa: E402
+from models import db, Question, Category  # noqa: E402
+from harness import database_path  # noqa: E402
+
+
+def cpu_us(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        samples.append((time.process_time() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--database', default=database_path)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    client = app.test_client()
+    with app.app_context():
+        categories = {c.id: c.type for c in Category.query.all()}
+        pages = {size: {
+            'success': True,
+            'questions': [q.format() for q in Question.query.order_by(
+                Question.id).limit(size)],
+            'total_questions': size,
+            'categories': categories,
+            'current_category': None,
+        } for size in args.sizes}
+        db.session.remove()
+
+    print(f'serialization, median CPU of {args.repeat} runs')
+    for size, page in pages.items():
+        stdlib = cpu_us(lambda: json.dumps(page, sort_keys=True), args.repeat)
+        line = f'{size:5} questions  json {stdlib:9.1f} us'
+        if encoding.orjson is not None:
+            fast = cpu_us(lambda: FastJSONEncoder(sort_keys=True).encode(page),
+                          args.repeat)
+            line += f'  orjson {fast:9.1f} us  ({stdlib / fast:.1f}x)'
+        print(line)
+
+    print('\nbytes on the wire for GET /questions (10 questions)')
+    for coding in ['identity'] + encoding.encodings():
+        res = client.get('/questions', headers={'Accept-Encoding': coding})
+        print(f'{coding:9} {len(res.data):7} bytes')
+    for size, page in pages.items():
+        body = json.dumps(page, sort_keys=True).encode()
+        line = f'{size:5} questions  identity {len(body):8}'
+        for coding in encoding.encodings():
+            line += f'  {coding} {len(encoding.compress(body, coding)):8}'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
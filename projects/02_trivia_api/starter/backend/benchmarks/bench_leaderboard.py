@@ -0,0 +1,108 @@
+"""Compares leaderboard queries on the in-memory ranking with SQL.
+
+Fills the global board of the trivia_bench database's leaderboard table
+with --players random scores, then reports the median time of a top-10
+page, a page deep in the board and a player's rank, served by the
+Leaderboard's skip list and by ORDER BY / COUNT queries over the table,
+as well as the one-off load time and the cost of applying a new best:
+
+    python benchmarks/bench_leaderboard.py --players 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app  # noqa: E402
+from harness import database_path  # noqa: E402
+from leaderboard import GLOBAL  # noqa: E402
+from models import db, LeaderboardEntry  # noqa: E402
+
+BATCH_SIZE = 10000
+
+TOP = ('SELECT player, score FROM leaderboard WHERE category = 0 '
+       'ORDER BY score DESC, achieved_at, player LIMIT 10 OFFSET :offset')
+RANK = ('SELECT count(*) + 1 FROM leaderboard WHERE category = 0 AND '
+        '(score > :score OR score = :score AND achieved_at < :achieved_at)')
+
+
+def fill(players):
+    rng = random.Random(0)
+    start = datetime(2020, 1, 1)
+    db.session.execute(LeaderboardEntry.__table__.delete())
+    for first in range(0, players, BATCH_SIZE):
+        db.session.execute(LeaderboardEntry.__table__.insert(), [
+            {'category': GLOBAL, 'player': f'player{i}',
+             'score': rng.randrange(50),
+             'achieved_at': start + timedelta(seconds=i)}
+            for i in range(first, min(first + BATCH_SIZE, players))])
+    db.session.commit()
+
+
+def median_us(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--players', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--database', default=database_path)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    with app.app_context():
+        fill(args.players)
+        leaderboard = app.extensions['leaderboard']
+        start = time.perf_counter()
+        leaderboard.top(GLOBAL, 10)
+        print(f'load {args.players} players: '
+              f'{time.perf_counter() - start:.2f} s')
+
+        middle = args.players // 2
+        player = f'player{middle}'
+        row = db.session.query(LeaderboardEntry).get((GLOBAL, player))
+        cases = {
+            'top 10': (
+                lambda: leaderboard.top(GLOBAL, 10),
+                lambda: db.session.execute(TOP, {'offset': 0}).fetchall()),
+            f'page at {middle}': (
+                lambda: leaderboard.top(GLOBAL, 10, middle),
+                lambda: db.session.execute(
+                    TOP, {'offset': middle}).fetchall()),
+            'rank of a player': (
+                lambda: leaderboard.standings(player),
+                lambda: db.session.execute(RANK, {
+                    'score': row.score,
+                    'achieved_at': row.achieved_at}).scalar()),
+        }
+        for name, (ranked, sql) in cases.items():
+            memory, query = (median_us(ranked, args.repeat),
+                             median_us(sql, args.repeat))
+            print(f'{name:24} skip list {memory:10.1f} us   '
+                  f'SQL {query:10.1f} us')
+
+        rng = random.Random(1)
+        now = datetime.utcnow()
+
+        def new_best():
+            leaderboard._apply(GLOBAL, f'player{rng.randrange(args.players)}',
+                               rng.randrange(50, 100), now)
+        print(f'{"apply a new best":24} skip list '
+              f'{median_us(new_best, args.repeat):10.1f} us')
+        db.session.execute(LeaderboardEntry.__table__.delete())
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
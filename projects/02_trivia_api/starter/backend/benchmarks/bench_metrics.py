@@ -0,0 +1,63 @@
+"""Measures what request metrics cost per request.
+
+Serves the same requests through the Flask test client of an app with
+METRICS_ENABLED and of one without, alternating rounds so both see the
+same database state, and reports the median CPU time per request and the
+difference. Also times one /metrics scrape. Uses the trivia_bench
+database as it is; seed it with harness.py or bench_pagination.py first:
+
+    python benchmarks/bench_metrics.py --requests 2000
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app  # noqa: E402
+from harness import database_path  # noqa: E402
+
+URLS = ('/categories', '/questions?page=2', '/categories/2/questions')
+
+
+def cpu_us(client, url, requests):
+    start = time.process_time()
+    for _ in range(requests):
+        client.get(url)
+    return (time.process_time() - start) * 1e6 / requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--database', default=database_path)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        clients = {enabled: create_app({
+            'SQLALCHEMY_DATABASE_URI': args.database,
+            'METRICS_ENABLED': enabled,
+            'METRICS_DIR': directory}).test_client()
+            for enabled in (False, True)}
+        for url in URLS:
+            samples = {False: [], True: []}
+            for enabled, client in clients.items():
+                cpu_us(client, url, 50)
+            for _ in range(args.rounds):
+                for enabled, client in clients.items():
+                    samples[enabled].append(
+                        cpu_us(client, url, args.requests // args.rounds))
+            off = statistics.median(samples[False])
+            on = statistics.median(samples[True])
+            print(f'{url:28} off {off:8.1f} us  on {on:8.1f} us  '
+                  f'overhead {on - off:6.1f} us ({(on - off) / off:+.1%})')
+        scrape = cpu_us(clients[True], '/metrics', 100)
+        print(f'{"/metrics scrape":28} {scrape:8.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Measures the CPU a /questions page costs the app process per request.
+
+Builds the same pages three ways and reports the median process CPU time
+(time.process_time, so database work in the PostgreSQL server is not
+counted) of each:
+
+- orm: Question objects, Question.format() per row, then serialized,
+  as /questions did before
+- core: paginate_questions on plain Core rows (the SQLite path)
+- database: paginate_questions with the JSON array built by json_agg
+
+then times whole /questions requests with DATABASE_JSON_PAGES on and off,
+page cache disabled. Uses the trivia_bench database:
+
+    python benchmarks/bench_page_json.py --size 100000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import request  # noqa: E402
+from flaskr import create_app, paginate_questions, QUESTIONS_PER_PAGE  # noqa: E402
+from encoding import dumps  # noqa: E402
+from harness import database_path  # noqa: E402
+from dataset import seed  # noqa: E402
+from models import Question  # noqa: E402
+
+URLS = ('/questions?page=2', '/questions?after=50000',
+        '/categories/3/questions?page=2')
+
+
+def cpu_us(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        samples.append((time.process_time() - start) * 1e6)
+    return statistics.median(samples)
+
+
+def orm_page(category):
+    query = Question.query
+    if category is not None:
+        query = query.filter_by(category=category)
+    total = query.order_by(None).count()
+    query = query.order_by(Question.id)
+    after = request.args.get('after', type=int)
+    if after is not None:
+        query = query.filter(Question.id > after)
+    else:
+        page = max(request.args.get('page', 1, type=int), 1)
+        query = query.offset((page - 1) * QUESTIONS_PER_PAGE)
+    questions = [q.format() for q in query.limit(QUESTIONS_PER_PAGE).all()]
+    return dumps(questions), len(questions), total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--database', default=database_path)
+    args = parser.parse_args()
+
+    apps = {enabled: create_app({
+        'SQLALCHEMY_DATABASE_URI': args.database,
+        'DATABASE_JSON_PAGES': enabled,
+        'PAGE_CACHE_SIZE': 0}) for enabled in (True, False)}
+    app = apps[True]
+    with app.app_context():
+        seed(args.size)
+
+    print('page assembly, CPU per page')
+    for url in URLS:
+        category = 3 if url.startswith('/categories') else None
+        with app.test_request_context(url):
+            ways = {
+                'orm': lambda: orm_page(category),
+                'core': lambda: paginate_questions(request, category, False),
+                'database': lambda: paginate_questions(
+                    request, category, True),
+            }
+            times = {name: cpu_us(fn, args.repeat)
+                     for name, fn in ways.items()}
+        print(f'{url:34} ' + '  '.join(
+            f'{name} {us:7.1f} us' for name, us in times.items()) +
+            f'  saved {times["orm"] - times["database"]:6.1f} us '
+            f'({1 - times["database"] / times["orm"]:.0%})')
+
+    print('whole requests, CPU per request')
+    for url in URLS:
+        times = {enabled: cpu_us(lambda: apps[enabled].test_client().get(url),
+                                 args.repeat)
+                 for enabled in (False, True)}
+        print(f'{url:34} core {times[False]:7.1f} us  '
+              f'database {times[True]:7.1f} us  '
+              f'saved {times[False] - times[True]:6.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Times the paginated question endpoints against a large question bank.
+
+Seeds a PostgreSQL database with synthetic questions (1M by default) and
+reports the median latency of shallow, deep (OFFSET) and keyset pages for
+/questions, /categories/<id>/questions and /questions/search.
+
+    createdb trivia_bench
+    python benchmarks/bench_pagination.py --questions 1000000 --legacy
+
+--legacy also times the previous implementation, which loaded and formatted
+every matching question before slicing out the page.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app, QUESTIONS_PER_PAGE  # noqa: E402
+from models import db, Question  # noqa: E402
+from harness import database_path  # noqa: E402
+from dataset import seed  # noqa: E402
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--questions', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--legacy', action='store_true')
+    parser.add_argument('--database', default=database_path)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    client = app.test_client()
+    with app.app_context():
+        seed(args.questions)
+        last_page = args.questions // QUESTIONS_PER_PAGE
+        deep_id = args.questions - QUESTIONS_PER_PAGE
+
+    cases = [
+        ('/questions?page=1', 'GET', None),
+        (f'/questions?page={last_page}', 'GET', None),
+        (f'/questions?after={deep_id}', 'GET', None),
+        ('/categories/3/questions?page=1', 'GET', None),
+        (f'/categories/3/questions?page={last_page // 6}', 'GET', None),
+        ('/questions/search?page=1', 'POST', {'searchTerm': 'title 42'}),
+    ]
+    print(f'{args.questions} questions, median of {args.repeat} runs')
+    for url, method, body in cases:
+        ms = timed(lambda: client.open(url, method=method, json=body),
+                   args.repeat)
+        print(f'{method:4} {url:45} {ms:10.2f} ms')
+
+    if args.legacy:
+        with app.app_context():
+            def legacy_page():
+                questions = [q.format() for q in
+                             Question.query.order_by(Question.id).all()]
+                return questions[:QUESTIONS_PER_PAGE]
+            ms = timed(legacy_page, 1)
+            db.session.remove()
+        print(f'{"legacy (load + format all, slice page 1)":50} {ms:10.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Times the similar-questions index over a synthetic question bank.
+
+Reports how long building the TF-IDF matrix takes, then the median time
+of a top-10 query answered by the sparse matrix-vector product and by a
+Python loop computing the same cosine over every question, and of adding
+a question. Uses the trivia_bench database:
+
+    pip install numpy scipy
+    python benchmarks/bench_similar.py --size 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app  # noqa: E402
+from harness import database_path  # noqa: E402
+from dataset import seed  # noqa: E402
+from models import db  # noqa: E402
+from similar import SimilarityIndex, question_rows  # noqa: E402
+
+
+def median_ms(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def loop_similar(vectors, question_id, k=10):
+    """the cosine of every question, one by one, as dicts"""
+    query = vectors[question_id]
+    scores = []
+    for other, vector in vectors.items():
+        if other != question_id:
+            score = sum(weight * vector.get(column, 0)
+                        for column, weight in query.items())
+            if score > 0:
+                scores.append((-score, other))
+    return [(other, -score) for score, other in sorted(scores)[:k]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--database', default=database_path)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    with app.app_context():
+        seed(args.size)
+        rows = list(question_rows(db.session))
+    start = time.perf_counter()
+    index = SimilarityIndex.build(rows)
+    print(f'build {len(index)} questions, {len(index.idf)} terms, '
+          f'{index.main.nnz} weights: {time.perf_counter() - start:.2f} s')
+
+    main_matrix = index.main
+    vectors = {}
+    for row, question_id in enumerate(index.main_ids.tolist()):
+        start, end = main_matrix.indptr[row:row + 2]
+        vectors[question_id] = dict(zip(main_matrix.indices[start:end].tolist(),
+                                        main_matrix.data[start:end].tolist()))
+    rng = random.Random(0)
+    ids = [row[0] for row in rows]
+    print(f'{"top 10, matrix-vector":26} '
+          f'{median_ms(lambda: index.similar(rng.choice(ids)), args.repeat):10.2f} ms')
+    print(f'{"top 10, Python loop":26} '
+          f'{median_ms(lambda: loop_similar(vectors, rng.choice(ids)), 3):10.2f} ms')
+    sample = rng.choice(ids)
+    # the same scores; ties may come in another order
+    assert [round(score, 3) for _, score in index.similar(sample)] == [
+        round(score, 3) for _, score in loop_similar(vectors, sample)]
+
+    next_id = max(ids) + 1
+
+    def add():
+        nonlocal next_id
+        index.add(next_id, f'Synthetic question {next_id} about title 7',
+                  f'Answer {next_id}')
+        next_id += 1
+    print(f'{"add a question":26} {median_ms(add, args.repeat * 10):10.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Compares ways of serving questions per category and difficulty.
+
+On the trivia_bench question bank (seeded with --size questions unless it
+already has them) reports the median time of a GROUP BY over the
+questions table, a read of the question_counts table and a /stats
+request served from the page cache, plus the cost the counts add to
+creating and deleting a question:
+
+    python benchmarks/bench_stats.py --size 1000000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app  # noqa: E402
+from harness import database_path  # noqa: E402
+from dataset import seed  # noqa: E402
+from models import db, Question, QuestionCount  # noqa: E402
+from stats import actual_counts, add_counts, count_key  # noqa: E402
+
+
+def median_ms(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--database', default=database_path)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    client = app.test_client()
+    with app.app_context():
+        seed(args.size)
+        client.get('/stats')
+        cases = {
+            'GROUP BY questions': lambda: actual_counts(db.session),
+            'read question_counts': lambda: QuestionCount.query.all(),
+            'GET /stats (cached)': lambda: client.get('/stats'),
+        }
+        for name, fn in cases.items():
+            print(f'{name:24} {median_ms(fn, args.repeat):10.3f} ms')
+
+        question = Question.query.first()
+        key = count_key(question.category, question.difficulty)
+
+        def count_write():
+            add_counts(db.session, {key: 1})
+            add_counts(db.session, {key: -1})
+        print(f'{"counts per write":24} '
+              f'{median_ms(count_write, args.repeat) / 2:10.3f} ms')
+        db.session.rollback()
+
+
+if __name__ == '__main__':
+    main()
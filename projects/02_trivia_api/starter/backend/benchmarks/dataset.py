@@ -0,0 +1,66 @@
+"""Synthetic question banks for the benchmark scripts.
+
+Questions are generated in SQL, so seeding a million rows takes seconds.
+Every question mentions "title <n>" (n < 997) plus a few words of a small
+vocabulary, so full-text searches have selective and broad terms to hit.
+"""
+import glob
+import os
+
+from flask import current_app
+
+from cache import question_stamps
+from models import db, Question
+from stats import reconcile
+
+CATEGORIES = 6
+VOCABULARY = [
+    'river', 'planet', 'painter', 'novel', 'empire', 'element', 'goal',
+    'album', 'ocean', 'mountain', 'inventor', 'treaty', 'festival',
+    'comet', 'desert', 'opera', 'league', 'dynasty', 'glacier', 'theorem',
+]
+MIGRATIONS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+
+def migrate():
+    """applies migrations/*.sql, all of which are safe to re-run"""
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for path in sorted(glob.glob(os.path.join(MIGRATIONS, '*.sql'))):
+            with open(path) as migration:
+                cursor.execute(migration.read())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def seed(total, categories=CATEGORIES):
+    """fills the questions table with `total` rows over `categories`
+    categories, unless it already holds exactly that many"""
+    if Question.query.count() == total:
+        return
+    db.session.execute('TRUNCATE questions, categories RESTART IDENTITY CASCADE')
+    db.session.execute(
+        "INSERT INTO categories (type) SELECT 'Category ' || i "
+        "FROM generate_series(1, :categories) AS i",
+        {'categories': categories})
+    db.session.execute(
+        "INSERT INTO questions (question, answer, category, difficulty) "
+        "SELECT 'Synthetic question ' || i || ' about title ' || i % 997 "
+        "       || ' ' || (:words)[1 + i % :size] "
+        "       || ' ' || (:words)[1 + i * 7 % :size], "
+        "'Answer ' || i, 1 + i % :categories, 1 + i % 5 "
+        "FROM generate_series(1, :total) AS i",
+        {'total': total, 'categories': categories, 'words': VOCABULARY,
+         'size': len(VOCABULARY)})
+    reconcile(db.session)
+    db.session.commit()
+    migrate()
+    db.session.execute('ANALYZE')
+    db.session.commit()
+    # raw SQL fires no mapper events, so move the list etags here
+    stamps = current_app.extensions['version_stamps']
+    for name in ['categories'] + question_stamps(*range(1, categories + 1)):
+        stamps.bump(name)
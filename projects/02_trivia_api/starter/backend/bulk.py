@@ -0,0 +1,176 @@
+import json
+import time
+from collections import Counter
+from sqlalchemy import func, select
+
+from models import db, Question, Category
+from encoding import dumps
+from cache import record_writes, question_stamps
+from dedupe import (DuplicateCheck, fingerprint, hashes_of, candidates,
+                    index_missing)
+from stats import add_counts, count_key
+
+# rows per server-side cursor fetch and per INSERT round trip
+BATCH_SIZE = 1000
+# longest accepted NDJSON line, in bytes
+MAX_LINE = 64 * 1024
+# per-line errors reported back; later ones are only counted
+MAX_ERRORS = 100
+FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+
+def export_questions(batch_size=BATCH_SIZE):
+    """yields the question bank as NDJSON, one chunk per fetched batch
+
+        Rows are read through a server-side cursor, so memory stays at one
+        batch whatever the size of the table.
+        """
+    columns = [getattr(Question, field) for field in FIELDS]
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(
+            select(columns).order_by(Question.id))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield ''.join(
+                dumps(dict(zip(FIELDS, row)), sort_keys=False) + '\n'
+                for row in rows)
+
+
+def read_lines(stream, max_line=MAX_LINE):
+    """yields (line number, line or None when longer than `max_line`)"""
+    number = 0
+    while True:
+        line = stream.readline(max_line + 1)
+        if not line:
+            return
+        number += 1
+        if len(line) > max_line and not line.endswith(b'\n'):
+            # drop the rest of the oversized line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_line)
+            yield number, None
+        else:
+            yield number, line
+
+
+def validate(record, categories):
+    """
+        Returns:
+            Tuple: (insertable row or None, error message or None)
+        """
+    if not isinstance(record, dict):
+        return None, 'expected a JSON object'
+    row = {}
+    for field in ('question', 'answer'):
+        value = record.get(field)
+        if not isinstance(value, str) or not value.strip():
+            return None, f'{field} must be a non-empty string'
+        row[field] = value
+    try:
+        row['category'] = int(record.get('category'))
+        row['difficulty'] = int(record.get('difficulty'))
+    except (TypeError, ValueError):
+        return None, 'category and difficulty must be integers'
+    if row['category'] not in categories:
+        return None, f'unknown category {row["category"]}'
+    if not 1 <= row['difficulty'] <= 5:
+        return None, 'difficulty must be between 1 and 5'
+    return row, None
+
+
+def duplicate_error(match):
+    if 'id' in match:
+        return f'duplicate of question {match["id"]}'
+    return f'duplicate of line {match["label"]}'
+
+
+def import_questions(stream, batch_size=BATCH_SIZE, max_errors=MAX_ERRORS,
+                     allow_duplicates=False):
+    """bulk-inserts NDJSON questions read from a binary `stream`
+
+        Valid lines are inserted `batch_size` rows per statement in one
+        transaction; invalid ones, and near-duplicates of questions in the
+        bank or earlier in the input (unless `allow_duplicates`), are
+        skipped and reported. Ids in the input are ignored. Memory stays
+        at one batch plus one line.
+
+        Returns:
+            Dict: counts, per-line errors, elapsed seconds and rows/second
+        """
+    started = time.monotonic()
+    categories = {id for id, in db.session.query(Category.id)}
+    insert = Question.__table__.insert()
+    batch, imported, failed, errors = [], 0, 0, []
+    categories_written = set()
+    # Core inserts skip the mapper events that fingerprint and count new
+    # questions
+    indexed = db.session.query(func.max(Question.id)).scalar() or 0
+
+    def fail(number, error):
+        nonlocal failed
+        failed += 1
+        if len(errors) < max_errors:
+            errors.append({'line': number, 'error': error})
+
+    def flush():
+        nonlocal imported, indexed
+        rows = [row for _, row in batch]
+        if not allow_duplicates:
+            found = [fingerprint(row['question'], row['answer'])
+                     for row in rows]
+            matches = DuplicateCheck().check(
+                [(number, fp) for (number, _), fp in zip(batch, found)],
+                candidates(db.session, hashes_of(found)))
+            rows = []
+            for (number, row), match in zip(batch, matches):
+                if match is None:
+                    rows.append(row)
+                else:
+                    fail(number, duplicate_error(match))
+        if rows:
+            db.session.execute(insert, rows)
+            imported += len(rows)
+            categories_written.update(row['category'] for row in rows)
+            add_counts(db.session, Counter(
+                count_key(row['category'], row['difficulty'])
+                for row in rows))
+            # indexed before the next batch is checked against the bank
+            indexed = index_missing(db.session, indexed)
+
+    try:
+        for number, line in read_lines(stream):
+            if line is None:
+                row, error = None, f'line longer than {MAX_LINE} bytes'
+            elif not line.strip():
+                continue
+            else:
+                try:
+                    row, error = validate(json.loads(line), categories)
+                except ValueError as err:
+                    row, error = None, f'invalid JSON: {err}'
+            if error:
+                fail(number, error)
+                continue
+            batch.append((number, row))
+            if len(batch) >= batch_size:
+                flush()
+                batch = []
+        if batch:
+            flush()
+        if imported:
+            # Core inserts fire no mapper events, so list etags move here
+            record_writes(db.session, *question_stamps(*categories_written))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    seconds = time.monotonic() - started
+    return {
+        'imported': imported,
+        'failed': failed,
+        'errors': sorted(errors, key=lambda error: error['line']),
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(imported / seconds) if seconds else imported,
+    }
@@ -0,0 +1,242 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import object_session
+
+from models import db, Category, Question
+from encoding import dumps
+
+'''
+VersionStamps
+    named counters in a small memory-mapped file, shared by every worker
+    process of the app. Reading a stamp is a memory read, so callers can
+    check freshness without touching the database. Per-category question
+    counters ("questions:<category id>") share the slots left over.
+    The last slot holds the file's epoch, a random number written when the
+    file is created: counters start again at 0 in a new file (after a
+    reboot or a temp dir cleanup), so tags built from them carry the epoch
+    to never match a tag handed out for other content.
+'''
+
+
+class VersionStamps:
+    SLOTS = 64
+    SLOT = struct.Struct('<Q')
+    NAMES = {'categories': 0, 'questions': 1, 'leaderboard': 2}
+    EPOCH = SLOTS
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = (self.SLOTS + 1) * self.SLOT.size
+            # one process creates the epoch, the others wait and read it
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self.map = mmap.mmap(fd, size)
+                offset = self.EPOCH * self.SLOT.size
+                epoch = self.SLOT.unpack_from(self.map, offset)[0]
+                while not epoch:
+                    epoch = int.from_bytes(os.urandom(self.SLOT.size),
+                                           'little')
+                    self.SLOT.pack_into(self.map, offset, epoch)
+                self.epoch = f'{epoch:016x}'
+            finally:
+                # the map keeps a duplicate of fd, which would hold the lock
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def for_app(cls, app):
+        """stamps file of this app's database, unless VERSION_STAMPS_PATH
+        is configured"""
+        return cls.for_database(app.config['SQLALCHEMY_DATABASE_URI'],
+                                app.config.get('VERSION_STAMPS_PATH'))
+
+    @classmethod
+    def for_database(cls, uri, path=None):
+        """stamps file shared by every app serving the database at `uri`"""
+        if path is None:
+            path = os.path.join(
+                tempfile.gettempdir(), 'trivia-versions-' +
+                hashlib.sha1(uri.encode()).hexdigest()[:12])
+        return cls(path)
+
+    def slot(self, name):
+        if name in self.NAMES:
+            return self.NAMES[name]
+        # two categories sharing a slot only costs extra cache misses
+        prefix, _, key = name.partition(':')
+        if prefix != 'questions':
+            raise KeyError(name)
+        spare = self.SLOTS - len(self.NAMES)
+        return len(self.NAMES) + int(key) % spare
+
+    def get(self, name):
+        offset = self.slot(name) * self.SLOT.size
+        return self.SLOT.unpack_from(self.map, offset)[0]
+
+    def etag(self, prefix, *names):
+        """tag of content built at the current versions of `names`"""
+        return '-'.join([prefix, self.epoch] +
+                        [str(self.get(name)) for name in names])
+
+    def bump(self, name):
+        offset = self.slot(name) * self.SLOT.size
+        with open(self.path, 'rb') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                version = self.SLOT.unpack_from(self.map, offset)[0] + 1
+                self.SLOT.pack_into(self.map, offset, version)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return version
+
+
+'''
+CategoryCache
+    the {id: type} category map and its serialized JSON, rebuilt only when
+    the "categories" version stamp moves (or after `max_age` seconds, for
+    writes made outside the app)
+'''
+
+
+class CategoryCache:
+
+    def __init__(self, stamps, max_age=300):
+        self.stamps = stamps
+        self.max_age = max_age
+        self.entry = None
+
+    def get(self):
+        """
+        Returns:
+            Tuple: (version, {id: type} dict, the dict serialized as JSON)
+        """
+        version = self.stamps.get('categories')
+        entry = self.entry
+        if (entry is None or entry[0] != version or
+                time.monotonic() - entry[3] > self.max_age):
+            categories = {c.id: c.type for c in Category.query.all()}
+            entry = (version, categories,
+                     dumps(categories),
+                     time.monotonic())
+            self.entry = entry
+        return entry[:3]
+
+    def etag(self):
+        return self.stamps.etag('categories', 'categories')
+
+    def reset(self):
+        self.entry = None
+
+
+'''
+PageCache
+    serialized list pages keyed by (etag, url). The etag carries the
+    version stamps the page was built from, and their epoch, so a write
+    makes the old entries unreachable and they age out of the LRU.
+'''
+
+
+class PageCache:
+
+    def __init__(self, maxsize=256, max_age=300):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.max_age:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+
+    def set(self, key, body):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+def json_with_fragments(payload, **fragments):
+    """serializes `payload` and splices in already serialized JSON values"""
+    body = dumps(payload)
+    extra = ', '.join(f'"{key}": {value}' for key, value in fragments.items())
+    if not extra:
+        return body
+    return body[:-1] + (', ' if payload else '') + extra + '}'
+
+
+'''
+Category and question writes bump their stamps once the transaction
+commits, so other workers never rebuild from uncommitted rows.
+'''
+
+
+def record_writes(session, *names):
+    """stamps to bump when `session` commits"""
+    if session is not None:
+        session.info.setdefault('bump_stamps', set()).update(names)
+
+
+def question_stamps(*categories):
+    return ['questions'] + [f'questions:{category}'
+                            for category in categories if category is not None]
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def category_written(mapper, connection, category):
+    record_writes(object_session(category), 'categories')
+
+
+@event.listens_for(Question, 'after_insert')
+@event.listens_for(Question, 'after_update')
+@event.listens_for(Question, 'after_delete')
+def question_written(mapper, connection, question):
+    # a question moved to another category changes both listings
+    moved_from = inspect(question).attrs.category.history.deleted or []
+    record_writes(object_session(question),
+                  *question_stamps(question.category, *moved_from))
+
+
+@event.listens_for(db.session, 'after_commit')
+def bump_written_stamps(session):
+    names = session.info.pop('bump_stamps', None)
+    if not names or not has_app_context():
+        return
+    stamps = current_app.extensions.get('version_stamps')
+    if stamps is not None:
+        for name in names:
+            stamps.bump(name)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_written_stamps(session, previous_transaction):
+    session.info.pop('bump_stamps', None)
@@ -0,0 +1,311 @@
+import hashlib
+import json
+import random
+import re
+import struct
+import unicodedata
+from collections import defaultdict, namedtuple
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, exists, func, select
+
+from models import db, Question, QuestionFingerprint
+
+# share of common shingles from which two questions count as duplicates
+THRESHOLD = 0.8
+# characters per shingle
+SHINGLE = 5
+# 10 bands of 5 MinHash values: pairs from a similarity of about 0.63 up
+# share a band, and 0.8 pairs are caught 98% of the time
+BANDS = 10
+ROWS = 5
+# each MinHash value is the smallest shingle hash XORed with one mask,
+# several times cheaper in Python than a modular permutation per value
+MASKS = [random.Random(20201 + i).getrandbits(64)
+         for i in range(BANDS * ROWS)]
+NON_WORD = re.compile(r'[\W_]+', re.UNICODE)
+# rows fingerprinted per query when indexing the bank
+BATCH_SIZE = 1000
+# in a crowded LSH bucket, members are only compared with its lowest id
+MAX_BUCKET_PAIRS = 64
+
+Fingerprint = namedtuple('Fingerprint', 'text hashes shingles')
+
+
+def normalize(text):
+    """case-, accent- and punctuation-insensitive form of `text`"""
+    text = text or ''
+    if not text.isascii():
+        text = ''.join(c for c in unicodedata.normalize('NFKD', text)
+                       if not unicodedata.combining(c))
+    return NON_WORD.sub(' ', text.casefold()).strip()
+
+
+def _hash64(data, signed=True):
+    # signed to fit a BIGINT column
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          'big', signed=signed)
+
+
+def fingerprint(question, answer, signature=True):
+    """
+        Returns:
+            Fingerprint: normalized text, the hashes to index (the whole
+            text's, then one per LSH band; none without `signature`) and
+            the text's shingles, or None for an empty question
+        """
+    if not normalize(question):
+        return None
+    text = normalize(f'{question} {answer or ""}')
+    shingles = {text[i:i + SHINGLE]
+                for i in range(max(len(text) - SHINGLE + 1, 1))}
+    if not signature:
+        return Fingerprint(text, [], shingles)
+    values = [_hash64(shingle.encode(), signed=False) for shingle in shingles]
+    signature = [min(value ^ mask for value in values) for mask in MASKS]
+    hashes = [_hash64(b'=' + text.encode())]
+    for band in range(BANDS):
+        hashes.append(_hash64(struct.pack(
+            f'<B{ROWS}Q', band, *signature[band * ROWS:(band + 1) * ROWS])))
+    return Fingerprint(text, hashes, shingles)
+
+
+def similarity(first, second):
+    """Jaccard similarity of two fingerprints' shingles"""
+    if first.text == second.text:
+        return 1.0
+    return (len(first.shingles & second.shingles) /
+            len(first.shingles | second.shingles))
+
+
+def index_values(rows):
+    """(hash, question id) pairs to index for (id, question, answer) rows"""
+    values = []
+    for question_id, question, answer in rows:
+        found = fingerprint(question, answer)
+        if found is not None:
+            values.extend((value, question_id) for value in set(found.hashes))
+    return values
+
+
+def index_rows(conn, rows):
+    """stores the fingerprints of (id, question, answer) rows"""
+    values = [{'hash': value, 'question_id': question_id}
+              for value, question_id in index_values(rows)]
+    if values:
+        conn.execute(QuestionFingerprint.__table__.insert(), values)
+
+
+def index_missing(conn, after=0, batch_size=BATCH_SIZE):
+    """fingerprints questions with an id above `after` that have none
+
+        Returns:
+            Integer: the highest question id seen
+        """
+    while True:
+        rows = conn.execute(
+            select([Question.id, Question.question, Question.answer])
+            .where(Question.id > after)
+            .where(~exists().where(
+                QuestionFingerprint.question_id == Question.id))
+            .order_by(Question.id).limit(batch_size)).fetchall()
+        if not rows:
+            return after
+        index_rows(conn, rows)
+        after = rows[-1][0]
+
+
+def hashes_of(fingerprints):
+    return {value for found in fingerprints if found is not None
+            for value in found.hashes}
+
+
+def candidates(conn, hashes):
+    """(id, question, answer) of indexed questions sharing any of `hashes`"""
+    if not hashes:
+        return []
+    return conn.execute(
+        select([Question.id, Question.question, Question.answer])
+        .where(Question.id.in_(
+            select([QuestionFingerprint.question_id])
+            .where(QuestionFingerprint.hash.in_(list(hashes)))))
+        .order_by(Question.id)).fetchall()
+
+
+'''
+DuplicateCheck
+    finds near-duplicates of new questions among candidate rows from the
+    fingerprint index and among the new questions checked before them.
+    The index only narrows the candidates down; every match is confirmed
+    on the shingles.
+'''
+
+
+class DuplicateCheck:
+
+    def __init__(self, threshold=THRESHOLD):
+        self.threshold = threshold
+        self.seen = defaultdict(list)
+
+    def check(self, entries, rows):
+        """
+            Args:
+                entries : (label, fingerprint) of the new questions
+                rows : candidate (id, question, answer) rows, from
+                    candidates() over the entries' hashes
+
+            Returns:
+                List: per entry, None or the best match as {'id' or
+                'label', 'similarity'}; entries without a match are
+                remembered for the next ones
+            """
+        indexed = defaultdict(list)
+        for question_id, question, answer in rows:
+            found = fingerprint(question, answer)
+            if found is not None:
+                for value in found.hashes:
+                    indexed[value].append(({'id': question_id}, found))
+        results = []
+        for label, found in entries:
+            if found is None:
+                results.append(None)
+                continue
+            match = self.best(found, indexed) or self.best(found, self.seen)
+            if match is None:
+                for value in found.hashes:
+                    self.seen[value].append(({'label': label}, found))
+            results.append(match)
+        return results
+
+    def best(self, found, buckets):
+        best = None
+        for value in found.hashes:
+            for key, other in buckets.get(value, ()):
+                score = similarity(found, other)
+                if score >= self.threshold and (
+                        best is None or score > best['similarity']):
+                    best = dict(key, similarity=round(score, 3))
+        return best
+
+
+def find_duplicates(question, answer, threshold=THRESHOLD):
+    """indexed questions at least `threshold` similar to a new one
+
+        Returns:
+            List: {'id', 'similarity'} dicts, most similar first
+        """
+    found = fingerprint(question, answer)
+    if found is None:
+        return []
+    return matches(found, candidates(db.session, found.hashes), threshold)
+
+
+def matches(found, rows, threshold=THRESHOLD):
+    """candidate (id, question, answer) rows at least `threshold` similar
+    to the fingerprint `found`, most similar first"""
+    results = []
+    for question_id, question, answer in rows:
+        other = fingerprint(question, answer, signature=False)
+        score = similarity(found, other) if other is not None else 0
+        if score >= threshold:
+            results.append({'id': question_id,
+                            'similarity': round(score, 3)})
+    return sorted(results, key=lambda match: -match['similarity'])
+
+
+def clusters(conn, threshold=THRESHOLD):
+    """groups of near-duplicate questions across the whole bank
+
+        Only questions sharing an indexed hash are compared, and within a
+        bucket each member only with the bucket's lowest id; matches are
+        merged transitively.
+
+        Returns:
+            List: sorted lists of question ids, largest groups first
+        """
+    index_missing(conn)
+    shared = select([QuestionFingerprint.hash]).group_by(
+        QuestionFingerprint.hash).having(func.count() > 1)
+    rows = conn.execute(
+        select([QuestionFingerprint.hash, QuestionFingerprint.question_id])
+        .where(QuestionFingerprint.hash.in_(shared))
+        .order_by(QuestionFingerprint.hash, QuestionFingerprint.question_id))
+    pairs, bucket, first = set(), None, None
+    for value, question_id in rows:
+        if value != bucket:
+            bucket, first, size = value, question_id, 0
+            continue
+        size += 1
+        if size <= MAX_BUCKET_PAIRS:
+            pairs.add((first, question_id))
+
+    ids = sorted({question_id for pair in pairs for question_id in pair})
+    fingerprints = {}
+    for start in range(0, len(ids), BATCH_SIZE):
+        for question_id, question, answer in conn.execute(
+                select([Question.id, Question.question, Question.answer])
+                .where(Question.id.in_(ids[start:start + BATCH_SIZE]))):
+            fingerprints[question_id] = fingerprint(
+                question, answer, signature=False)
+
+    parent = {}
+
+    def root(question_id):
+        while parent.get(question_id, question_id) != question_id:
+            question_id = parent[question_id]
+        return question_id
+
+    for first, second in pairs:
+        if (fingerprints.get(first) and fingerprints.get(second) and
+                root(first) != root(second) and
+                similarity(fingerprints[first], fingerprints[second]) >=
+                threshold):
+            parent[root(second)] = root(first)
+    groups = defaultdict(list)
+    for question_id in parent:
+        groups[root(question_id)].append(question_id)
+    for group_root, members in groups.items():
+        if group_root not in parent:
+            members.append(group_root)
+    return sorted((sorted(group) for group in groups.values()),
+                  key=lambda group: (-len(group), group[0]))
+
+
+@click.command('duplicates')
+@click.option('--threshold', default=THRESHOLD, show_default=True,
+              help='similarity from which questions are duplicates')
+@with_appcontext
+def duplicates_command(threshold):
+    """Index the question bank and print its near-duplicate groups as
+    NDJSON, largest first."""
+    with db.engine.begin() as conn:
+        groups = clusters(conn, threshold)
+    for group in groups:
+        question = db.session.query(Question.question).filter(
+            Question.id == group[0]).scalar()
+        click.echo(json.dumps({'ids': group, 'question': question}))
+    click.echo(f'{len(groups)} groups, '
+               f'{sum(len(group) - 1 for group in groups)} duplicates',
+               err=True)
+
+
+@event.listens_for(Question, 'after_insert')
+def question_inserted(mapper, connection, question):
+    index_rows(connection, [(question.id, question.question,
+                             question.answer)])
+
+
+@event.listens_for(Question, 'after_delete')
+def question_deleted(mapper, connection, question):
+    # the foreign key cascades on PostgreSQL, not on SQLite
+    connection.execute(QuestionFingerprint.__table__.delete().where(
+        QuestionFingerprint.question_id == question.id))
+
+
+@event.listens_for(Question, 'after_update')
+def question_updated(mapper, connection, question):
+    if question.previous('question', 'answer') is None:
+        return
+    question_deleted(mapper, connection, question)
+    question_inserted(mapper, connection, question)
@@ -0,0 +1,93 @@
+import gzip
+import json
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # optional, pip install orjson
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional, pip install brotli
+    brotli = None
+
+# smaller bodies are sent as they are, compression would not pay off
+COMPRESS_MIN_SIZE = 500
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def dumps(obj, sort_keys=True):
+    """serializes `obj` with orjson when it is installed"""
+    if orjson is not None:
+        try:
+            option = orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, option=option).decode()
+        except TypeError:
+            pass
+    return json.dumps(obj, sort_keys=sort_keys)
+
+
+'''
+FastJSONEncoder
+    Flask's JSON encoder (app.json_encoder, used by jsonify) with the
+    encoding done by orjson. Values orjson cannot encode natively, and
+    dates, keep going through Flask's `default`, so responses look the same.
+'''
+
+
+class FastJSONEncoder(JSONEncoder):
+
+    def encode(self, o):
+        if orjson is None or self.indent is not None:
+            return super().encode(o)
+        option = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME |
+                  orjson.OPT_PASSTHROUGH_DATACLASS)
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(o, default=self.default, option=option).decode()
+        except TypeError:
+            # e.g. integers beyond 64 bits
+            return super().encode(o)
+
+
+def encodings():
+    """content codings this process can produce, preferred first"""
+    return (['br'] if brotli is not None else []) + ['gzip']
+
+
+def compress(data, coding):
+    if coding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def compress_response(response, accept_encodings,
+                      min_size=COMPRESS_MIN_SIZE):
+    """compresses `response` with the best coding the client accepts
+
+        Args:
+            response : flask response, left alone when streamed, already
+                encoded, not a success or shorter than `min_size` bytes
+            accept_encodings : the request's parsed Accept-Encoding
+        """
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or response.is_streamed or
+            response.status_code < 200 or response.status_code >= 300 or
+            response.status_code == 204 or
+            'Content-Encoding' in response.headers):
+        return response
+    coding = accept_encodings.best_match(encodings())
+    if coding is None or response.calculate_content_length() < min_size:
+        return response
+    response.set_data(compress(response.get_data(), coding))
+    response.headers['Content-Encoding'] = coding
+    # the tag now names one of several encoded representations
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
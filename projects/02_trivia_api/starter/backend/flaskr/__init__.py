@@ -1,40 +1,139 @@
+import functools
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.sql.expression import func
 
 from flask_cors import CORS
 import random
-
-from models import setup_db, Question, Category
+from sqlalchemy import select, text
+
+from models import setup_db, database_path, db, Question, QuestionCount
+from quiz import (QuestionSampler, parse_quiz, quiz_steps,
+                  next_in_session_steps, run_steps)
+from cache import VersionStamps, CategoryCache, PageCache, json_with_fragments
+from search import create_search
+from bulk import export_questions, import_questions, FIELDS
+from encoding import (FastJSONEncoder, compress_response, COMPRESS_MIN_SIZE,
+                      dumps)
+from admission import AdmissionControl, QUEUE_TIMEOUT
+from dedupe import find_duplicates, duplicates_command
+from metrics import Metrics, CONTENT_TYPE
+from leaderboard import Leaderboard, GLOBAL, MAX_PLAYER_LENGTH
+from stats import question_stats, ensure_counts, reconcile_command
+from similar import SimilarQuestions, TOP_K, MAX_K, similar_index_command
 
 QUESTIONS_PER_PAGE = 10
 
 
-def paginate_questions(request, queryset):
-    """helper function that paginates questions
-        or any queryset that has formate to json method
+@functools.lru_cache(maxsize=None)
+def page_statement(by_category, keyset, in_database):
+    """SQL of a page of questions and the total, built once per variant:
+        SQLAlchemy would compile an expression again on every request"""
+    conditions = ['category = :category'] if by_category else []
+    total = 'SELECT count(*) FROM questions' + ''.join(
+        f' WHERE {condition}' for condition in conditions)
+    if keyset:
+        conditions.append('id > :after')
+    page = (f'SELECT {", ".join(FIELDS)} FROM questions' +
+            (' WHERE ' + ' AND '.join(conditions) if conditions else '') +
+            f' ORDER BY id LIMIT {QUESTIONS_PER_PAGE} OFFSET :offset')
+    if not in_database:
+        return text(page), text(total)
+    # keys in the order dumps() sorts them into; as text, or the driver
+    # would parse the array back into dicts
+    question = ', '.join(f"'{field}', {field}" for field in sorted(FIELDS))
+    return text(
+        f"SELECT coalesce(json_agg(json_build_object({question}) "
+        f"ORDER BY id), '[]')::text, count(*), ({total}) "
+        f"FROM ({page}) AS page"), None
+
+
+def paginate_questions(request, category=None, in_database=False):
+    """helper function that paginates questions in the database
+        only the requested page is fetched, as plain rows; the total
+        comes from a COUNT. `?after=<id>` switches from OFFSET to a
+        keyset seek, which stays cheap on deep pages. With `in_database`
+        PostgreSQL builds the page's JSON array itself (json_agg) and
+        sends it with the total in a single round trip.
 
         Args:
             request : flask request object
-            queryset : sqlalchemy queryset
+            category : only questions of this category id, if given
+            in_database : assemble the JSON in PostgreSQL
 
         Returns:
-            List: list of json formated items (page of the queryset)
+            Tuple: json formated questions of the page, already serialized,
+            the number of questions on the page, total count
         """
-
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    questions = [question.format() for question in queryset]
-    current_questions = questions[start:end]
-    return current_questions
+    after = request.args.get('after', type=int)
+    params = {'category': category, 'after': after, 'offset': 0}
+    if after is None:
+        page = max(request.args.get('page', 1, type=int), 1)
+        params['offset'] = (page - 1) * QUESTIONS_PER_PAGE
+    page, total = page_statement(category is not None, after is not None,
+                                 in_database)
+    if in_database:
+        return tuple(db.session.execute(page, params).first())
+    rows = db.session.execute(page, params).fetchall()
+    return (dumps([dict(zip(FIELDS, row)) for row in rows]), len(rows),
+            db.session.execute(total, params).scalar())
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.update(test_config)
+    app.json_encoder = FastJSONEncoder
+    app.config.setdefault('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+    setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path))
+    with app.app_context():
+        app.extensions['question_search'] = create_search(db.engine)
+        with db.engine.begin() as conn:
+            ensure_counts(conn)
+        # PostgreSQL only; elsewhere pages are serialized from Core rows
+        json_pages = (app.config.get('DATABASE_JSON_PAGES', True) and
+                      db.engine.dialect.name == 'postgresql')
+    app.extensions['version_stamps'] = VersionStamps.for_app(app)
+    stamps = app.extensions['version_stamps']
+    app.extensions['question_sampler'] = QuestionSampler(stamps)
+    category_cache = app.extensions['category_cache'] = CategoryCache(stamps)
+    page_cache = app.extensions['page_cache'] = PageCache(
+        app.config.get('PAGE_CACHE_SIZE', 256))
+    leaderboard = app.extensions['leaderboard'] = Leaderboard(stamps)
+    similar = app.extensions['similar_questions'] = SimilarQuestions.for_app(
+        app, stamps)
+    metrics = None
+    if app.config.get('METRICS_ENABLED', True):
+        # registered first, so its timing covers the other request hooks
+        metrics = app.extensions['metrics'] = Metrics.for_app(app)
+        with app.app_context():
+            metrics.init_app(app, db.engine)
+    admission = app.extensions['admission'] = AdmissionControl(
+        app.config.get('ADMISSION_LIMITS'),
+        app.config.get('ADMISSION_QUEUE_TIMEOUT', QUEUE_TIMEOUT))
+    admission.init_app(app)
+    app.cli.add_command(duplicates_command)
+    app.cli.add_command(reconcile_command)
+    app.cli.add_command(similar_index_command)
+
+    def versioned_page(etag, build):
+        """answers If-None-Match from the version stamps alone, then serves
+        the page from the page cache or `build()`"""
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            key = (etag, request.full_path)
+            body = page_cache.get(key)
+            if body is not None:
+                response = Response(body, mimetype='application/json')
+            else:
+                response = build()
+                if response.status_code != 200:
+                    return response
+                page_cache.set(key, response.get_data())
+        response.set_etag(etag)
+        return response
 
     '''
     @DONE: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
@@ -50,7 +149,8 @@ def create_app(test_config=None):
                              'Content-Type,Authorization,true')
         response.headers.add('Access-Control-Allow-Methods',
                              'GET,PUT,POST,DELETE,OPTIONS')
-        return response
+        return compress_response(response, request.accept_encodings,
+                                 app.config['COMPRESS_MIN_SIZE'])
     '''
     @DONE:
     Create an endpoint to handle GET requests
@@ -58,13 +158,17 @@ def create_app(test_config=None):
     '''
     @app.route('/categories')
     def get_categories():
-        categories = Category.query.all()
-        cats = {}
-        for c in categories:
-            cats[c.id] = c.type
-        return jsonify(
-            {'success': True,
-             "categories": cats})
+        # answered from the version stamp alone when the client is current
+        etag = category_cache.etag()
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            _, _, cats_json = category_cache.get()
+            response = Response(
+                json_with_fragments({'success': True}, categories=cats_json),
+                mimetype='application/json')
+        response.set_etag(etag)
+        return response
 
     '''
     @DONE:
@@ -81,21 +185,22 @@ def create_app(test_config=None):
 
     @app.route('/questions')
     def get_questions():
-        query_set = Question.query.order_by(Question.id).all()
-        categories = Category.query.all()
-        current_questions = paginate_questions(request, query_set)
-        cats = {}
-        for c in categories:
-            cats[c.id] = c.type
-        if len(current_questions) == 0:
-            abort(404)
-        return jsonify({
-            'success': True,
-            'questions': current_questions,
-            'total_questions': len(query_set),
-            'categories': cats,
-            'current_category': None
-        })
+        def build():
+            questions_json, page_size, total_questions = paginate_questions(
+                request, in_database=json_pages)
+            if page_size == 0:
+                abort(404)
+            _, _, cats_json = category_cache.get()
+            return Response(json_with_fragments({
+                'success': True,
+                'total_questions': total_questions,
+                'current_category': None
+            }, questions=questions_json, categories=cats_json),
+                mimetype='application/json')
+
+        # the page embeds the categories map, so both versions count
+        return versioned_page(
+            stamps.etag('questions', 'questions', 'categories'), build)
 
     '''
     @DONE:
@@ -128,6 +233,18 @@ def create_app(test_config=None):
     @app.route('/questions', methods=['POST'])
     def create_question():
         body = request.get_json()
+        try:
+            duplicates = [] if body.get('allow_duplicate') else \
+                find_duplicates(body.get('question'), body.get('answer'))
+        except (AttributeError, TypeError):
+            abort(400)
+        if duplicates:
+            return jsonify({
+                'success': False,
+                'error': 409,
+                'message': 'duplicate question',
+                'duplicates': duplicates
+            }), 409
         try:
             question = Question(
                 question=body.get('question'),
@@ -143,6 +260,43 @@ def create_app(test_config=None):
             print(err)
             abort(400)
 
+    @app.route('/questions/<int:question_id>/similar')
+    def get_similar_questions(question_id):
+        # the index needs numpy and scipy
+        if not similar.available():
+            abort(404)
+        k = max(1, min(request.args.get('k', TOP_K, type=int), MAX_K))
+        matches = similar.similar(question_id, k)
+        if matches is None:
+            abort(404)
+        table = Question.__table__
+        rows = {row.id: row for row in db.session.execute(
+            select([table.c[field] for field in FIELDS])
+            .where(table.c.id.in_([match for match, _ in matches])))}
+        # questions deleted by another worker are left out
+        return jsonify({
+            'success': True,
+            'question_id': question_id,
+            'questions': [dict(zip(FIELDS, rows[match]), similarity=score)
+                          for match, score in matches if match in rows]
+        })
+
+    @app.route('/questions/export')
+    def export_question_bank():
+        return Response(stream_with_context(export_questions()),
+                        mimetype='application/x-ndjson')
+
+    @app.route('/questions/import', methods=['POST'])
+    def import_question_bank():
+        # the body is read line by line, never loaded whole
+        report = import_questions(
+            request.stream,
+            allow_duplicates=request.args.get('allow_duplicates') == 'true')
+        # bulk inserts skip the mapper events that keep these current
+        app.extensions['question_sampler'].reset()
+        app.extensions['question_search'].reset()
+        return jsonify(dict(report, success=True))
+
     '''
     @DONE:
     Create a POST endpoint to get questions based on a search term.
@@ -155,22 +309,29 @@ def create_app(test_config=None):
     '''
     @app.route('/questions/search', methods=['POST'])
     def search_questions():
+        # ranked full-text match on question and answer, see search.py
+        body = request.get_json()
         try:
-            body = request.get_json()
-            term = body.get('searchTerm')
+            term = (body.get('searchTerm') or '').strip()
+            category = body.get('category')
+            difficulty = body.get('difficulty')
+            category = int(category) if category not in (None, '') else None
+            difficulty = (int(difficulty)
+                          if difficulty not in (None, '') else None)
+        except (AttributeError, TypeError, ValueError):
+            abort(400)
+        page = max(request.args.get('page', 1, type=int), 1)
 
-            matched_questions = Question.query.order_by(Question.id).filter(
-                Question.question.ilike('%' + term + '%')).all()
-            current_questions = paginate_questions(request, matched_questions)
+        current_questions, total_questions = app.extensions[
+            'question_search'].search(term, category, difficulty, page,
+                                      QUESTIONS_PER_PAGE)
 
-            return jsonify({
-                'success': True,
-                'questions': current_questions,
-                'total_questions': len(matched_questions),
-                "current_category": None
-            })
-        except:
-            abort(400)
+        return jsonify({
+            'success': True,
+            'questions': current_questions,
+            'total_questions': total_questions,
+            "current_category": category
+        })
 
     '''
     @DONE:
@@ -182,21 +343,21 @@ def create_app(test_config=None):
     '''
     @app.route('/categories/<int:category_id>/questions')
     def get_category_questions(category_id):
-
-        try:
-            questions_queryset = Question.query.filter_by(
-                category=str(category_id)).all()
-            questions = paginate_questions(request, questions_queryset)
-            print(questions)
-            return jsonify({
-                'success': True,
-                "questions": questions,
-                "total_questions": len(questions_queryset),
-                "current_category": category_id
-            })
-        except Exception as err:
-            print(err)
-            abort(500)
+        def build():
+            try:
+                questions_json, _, total_questions = paginate_questions(
+                    request, category_id, in_database=json_pages)
+                return Response(json_with_fragments({
+                    'success': True,
+                    "total_questions": total_questions,
+                    "current_category": category_id
+                }, questions=questions_json), mimetype='application/json')
+            except Exception as err:
+                print(err)
+                abort(500)
+
+        return versioned_page(stamps.etag(
+            f'category-{category_id}', f'questions:{category_id}'), build)
 
     '''
     @DONE:
@@ -211,29 +372,105 @@ def create_app(test_config=None):
     '''
     @app.route('/quizzes', methods=['POST'])
     def play_quiz():
+        try:
+            quiz = parse_quiz(request.get_json())
+        except ValueError:
+            abort(400)
+        return jsonify(run_steps(quiz_steps(
+            app.extensions['question_sampler'], quiz)))
+
+    @app.route('/quizzes/<session_id>/next', methods=['POST'])
+    def next_quiz_question(session_id):
+        payload = run_steps(next_in_session_steps(session_id))
+        if payload is None:
+            abort(404)
+        return jsonify(payload)
+
+    @app.route('/stats')
+    def get_stats():
+        def build():
+            counts = {(row.category, row.difficulty): row.count
+                      for row in QuestionCount.query}
+            return jsonify(dict(question_stats(
+                counts, category_cache.get()[1]), success=True))
+
+        # every question write moves the questions stamp
+        return versioned_page(
+            stamps.etag('stats', 'questions', 'categories'), build)
+
+    def board_category(value):
+        """category id of a leaderboard, 0 for the global one"""
+        category = int(value or GLOBAL)
+        if category != GLOBAL and category not in category_cache.get()[1]:
+            abort(404)
+        return category
+
+    @app.route('/leaderboard', methods=['POST'])
+    def submit_score():
         body = request.get_json()
-        previous_questions = body.get('previous_questions', [])
-        quiz_category = body.get('quiz_category')
-        random_questions = Question.query.filter(
-            Question.id.notin_(previous_questions)).order_by(func.random())
-        print(quiz_category)
-        if quiz_category is not None and previous_questions is not None:
-            random_questions = random_questions.filter_by(
-                category=quiz_category.get('id'))
-
-        random_question = random_questions.first()
-
-        if not random_question:
-            return jsonify({
-                'success': False,
-                'question': False
-            })
+        try:
+            player = body.get('player')
+            score = body.get('score')
+            category = body.get('category')
+        except AttributeError:
+            abort(400)
+        if (not isinstance(player, str) or not player.strip() or
+                len(player) > MAX_PLAYER_LENGTH or
+                not isinstance(score, int) or isinstance(score, bool) or
+                score < 0):
+            abort(422)
+        try:
+            category = board_category(category)
+        except (TypeError, ValueError):
+            abort(400)
+        standings = leaderboard.submit(player.strip(), category, score)
+        return jsonify({
+            'success': True,
+            'player': player.strip(),
+            'rank': standings[category]['rank'],
+            'score': standings[category]['score'],
+            'global_rank': standings[GLOBAL]['rank']
+        })
 
+    @app.route('/leaderboard')
+    def get_leaderboard():
+        category = board_category(request.args.get('category', GLOBAL,
+                                                   type=int))
+        limit = max(1, min(request.args.get('limit', 10, type=int), 100))
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        scores, players = leaderboard.top(category, limit, offset)
         return jsonify({
             'success': True,
-            'question': random_question.format()
+            'category': category,
+            'scores': scores,
+            'total_players': players
         })
 
+    @app.route('/leaderboard/players/<player>')
+    def get_player_standings(player):
+        standings = leaderboard.standings(player)
+        if not standings:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'player': player,
+            'boards': standings
+        })
+
+    @app.route('/admission')
+    def admission_stats():
+        # queue depth and shed requests of this worker process
+        return jsonify({
+            'success': True,
+            'endpoints': admission.stats()
+        })
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        if metrics is None:
+            abort(404)
+        return Response(metrics.render(), content_type=CONTENT_TYPE)
+
     '''
     @DONE: 
     Create error handlers for all expected errors 
@@ -0,0 +1,259 @@
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from models import db, LeaderboardEntry
+
+GLOBAL = 0
+# a skip list this tall stays O(log n) well past 10 million players
+MAX_LEVEL = 24
+# rows re-read on catch-up, for bests committed after later ones
+CATCH_UP_WINDOW = timedelta(seconds=5)
+MAX_PLAYER_LENGTH = 64
+
+'''
+RankedList
+    an indexable skip list of sort keys. Every link knows how many
+    entries it skips, so adding, removing, finding the rank of a key and
+    reaching the n-th entry are all O(log n).
+'''
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, height):
+        self.key = key
+        self.next = [None] * height
+        self.width = [1] * height
+
+
+class RankedList:
+
+    def __init__(self, seed=None):
+        self.head = _Node(None, MAX_LEVEL)
+        self.size = 0
+        self.random = random.Random(seed)
+
+    def __len__(self):
+        return self.size
+
+    def _path(self, key):
+        """the last node before `key` on every level and its position"""
+        chain = [None] * MAX_LEVEL
+        steps = [0] * MAX_LEVEL
+        node, position = self.head, 0
+        for level in reversed(range(MAX_LEVEL)):
+            while (node.next[level] is not None and
+                   node.next[level].key < key):
+                position += node.width[level]
+                node = node.next[level]
+            chain[level], steps[level] = node, position
+        return chain, steps
+
+    def add(self, key):
+        chain, steps = self._path(key)
+        height = 1
+        while height < MAX_LEVEL and self.random.random() < 0.5:
+            height += 1
+        node = _Node(key, height)
+        position = steps[0]
+        for level in range(height):
+            previous = chain[level]
+            node.next[level] = previous.next[level]
+            previous.next[level] = node
+            node.width[level] = previous.width[level] - (
+                position - steps[level])
+            previous.width[level] = position - steps[level] + 1
+        for level in range(height, MAX_LEVEL):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain, _ = self._path(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for level in range(MAX_LEVEL):
+            previous = chain[level]
+            if previous.next[level] is node:
+                previous.width[level] += node.width[level] - 1
+                previous.next[level] = node.next[level]
+            else:
+                previous.width[level] -= 1
+        self.size -= 1
+
+    def index(self, key):
+        """0-based position of `key`"""
+        chain, steps = self._path(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        return steps[0]
+
+    def slice(self, start, stop):
+        """the keys from position `start` up to `stop`"""
+        node, position = self.head, 0
+        for level in reversed(range(MAX_LEVEL)):
+            while (node.next[level] is not None and
+                   position + node.width[level] <= start):
+                position += node.width[level]
+                node = node.next[level]
+        keys = []
+        node = node.next[0]
+        while node is not None and len(keys) < stop - start:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+'''
+Leaderboard
+    each board's best scores in a RankedList of (-score, achieved_at,
+    player), best first, loaded once from the leaderboard summary table
+    and then kept current: new bests of this worker are applied as they
+    commit, those of other workers are read back by time when the
+    "leaderboard" version stamp moves. Fully reloaded every
+    `reload_seconds`, like the quiz sampler.
+'''
+
+
+class Leaderboard:
+
+    def __init__(self, stamps, reload_seconds=300):
+        self.stamps = stamps
+        self.reload_seconds = reload_seconds
+        self.lock = threading.Lock()
+        self.boards = None
+        self.version = None
+        self.latest = None
+        self.loaded_at = 0
+
+    def reset(self):
+        with self.lock:
+            self.boards = None
+
+    def _apply(self, category, player, score, achieved_at):
+        board = self.boards.get(category)
+        if board is None:
+            board = self.boards[category] = (RankedList(), {})
+        ranked, keys = board
+        key = (-score, achieved_at, player)
+        current = keys.get(player)
+        # bests only improve, so an older row never replaces a newer one
+        if current is not None:
+            if current <= key:
+                return
+            ranked.remove(current)
+        ranked.add(key)
+        keys[player] = key
+        if self.latest is None or achieved_at > self.latest:
+            self.latest = achieved_at
+
+    def _read(self, since=None):
+        query = select([LeaderboardEntry.category, LeaderboardEntry.player,
+                        LeaderboardEntry.score, LeaderboardEntry.achieved_at])
+        if since is not None:
+            query = query.where(LeaderboardEntry.achieved_at >= since)
+        for row in db.session.execute(query):
+            self._apply(*row)
+
+    def _refresh(self):
+        # read before the rows, so a write in between moves it again
+        version = self.stamps.get('leaderboard')
+        if (self.boards is None or
+                time.monotonic() - self.loaded_at > self.reload_seconds):
+            self.boards, self.latest = {}, None
+            self._read()
+            self.loaded_at = time.monotonic()
+        elif version != self.version and self.latest is not None:
+            self._read(self.latest - CATCH_UP_WINDOW)
+        elif version != self.version:
+            self._read()
+        self.version = version
+
+    def submit(self, player, category, score):
+        """records a quiz score on its category's board and the global
+        one, where it beats the player's best
+
+            Returns:
+                Dict: board -> the player's best score and rank
+            """
+        now = datetime.utcnow()
+        categories = sorted({GLOBAL, int(category or GLOBAL)})
+        entries = {entry.category: entry for entry in
+                   LeaderboardEntry.query.filter(
+                       LeaderboardEntry.player == player,
+                       LeaderboardEntry.category.in_(categories))
+                   .with_for_update()}
+        improved = []
+        for board in categories:
+            entry = entries.get(board)
+            if entry is None:
+                entry = LeaderboardEntry(category=board, player=player,
+                                         score=score, achieved_at=now)
+                db.session.add(entry)
+            elif score > entry.score:
+                entry.score, entry.achieved_at = score, now
+            else:
+                continue
+            improved.append((board, player, score, now))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a first score of the same player committed meanwhile
+            db.session.rollback()
+            return self.submit(player, category, score)
+        version = self.stamps.bump('leaderboard') if improved else None
+        with self.lock:
+            if (version is not None and self.boards is not None and
+                    version == self.version + 1):
+                # no other writes since the last refresh: skip reading back
+                self.version = version
+            else:
+                self._refresh()
+            for row in improved:
+                self._apply(*row)
+            return {board: self._standing(board, player)
+                    for board in categories}
+
+    def _standing(self, category, player):
+        ranked, keys = self.boards.get(category, (None, {}))
+        key = keys.get(player)
+        if key is None:
+            return None
+        return {'score': -key[0], 'rank': ranked.index(key) + 1}
+
+    def top(self, category, limit, offset=0):
+        """
+            Returns:
+                Tuple: ([{'rank', 'player', 'score'}] from rank
+                `offset` + 1 on, players on the board)
+            """
+        with self.lock:
+            self._refresh()
+            ranked, _ = self.boards.get(int(category), (RankedList(), {}))
+            scores = [{'rank': offset + position + 1, 'player': player,
+                       'score': -score}
+                      for position, (score, _, player) in enumerate(
+                          ranked.slice(offset, offset + limit))]
+            return scores, len(ranked)
+
+    def standings(self, player):
+        """
+            Returns:
+                Dict: board -> {'score', 'rank', 'players'} of every board
+                the player is on
+            """
+        with self.lock:
+            self._refresh()
+            result = {}
+            for category, (ranked, keys) in self.boards.items():
+                if player in keys:
+                    result[category] = dict(
+                        self._standing(category, player),
+                        players=len(ranked))
+            return result
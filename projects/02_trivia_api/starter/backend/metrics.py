@@ -0,0 +1,361 @@
+import bisect
+import glob
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# upper bounds of the latency histograms, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+INITIAL_SIZE = 64 * 1024
+USED = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# name -> (type, help). Gauges only count for processes still running.
+METRICS = {
+    'trivia_requests_total': (
+        'counter', 'Requests served, by method, route and status.'),
+    'trivia_request_duration_seconds': (
+        'histogram', 'Time to build a response, by route.'),
+    'trivia_request_db_seconds': (
+        'histogram', 'Time spent in database queries per request, by route.'),
+    'trivia_db_pool_size': (
+        'gauge', 'Connections the pools keep open.'),
+    'trivia_db_connections_open': (
+        'gauge', 'Database connections currently open.'),
+    'trivia_db_connections_in_use': (
+        'gauge', 'Database connections checked out of the pools.'),
+}
+# gauges a forked worker takes over: its pool has the same size, but none
+# of the parent's connections are its own
+INHERITED_GAUGES = ('trivia_db_pool_size',)
+
+'''
+ValueFile
+    float values by series name in a memory-mapped file written by one
+    process. New series are appended as (key length, key, value) and the
+    header's used size is moved last, so a reader in another process
+    always sees whole entries.
+'''
+
+
+class ValueFile:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = os.fstat(fd).st_size
+            if size < INITIAL_SIZE:
+                size = INITIAL_SIZE
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.used = USED.unpack_from(self.map)[0] or USED.size
+        self.offsets = {key: offset
+                        for key, offset in entries(self.map, self.used)}
+
+    def _offset(self, key):
+        offset = self.offsets.get(key)
+        if offset is None:
+            encoded = key.encode()
+            start = self.used + KEY_LENGTH.size
+            # values stay 8-byte aligned
+            offset = (start + len(encoded) + 7) & ~7
+            if offset + VALUE.size > len(self.map):
+                self._grow(offset + VALUE.size)
+            KEY_LENGTH.pack_into(self.map, self.used, len(encoded))
+            self.map[start:start + len(encoded)] = encoded
+            VALUE.pack_into(self.map, offset, 0.0)
+            self.used = offset + VALUE.size
+            USED.pack_into(self.map, 0, self.used)
+            self.offsets[key] = offset
+        return offset
+
+    def _grow(self, needed):
+        size = len(self.map)
+        while size < needed:
+            size *= 2
+        self.map.close()
+        with open(self.path, 'r+b') as values:
+            values.truncate(size)
+            self.map = mmap.mmap(values.fileno(), size)
+
+    def add(self, items):
+        """adds each (key, amount) of `items` to its series"""
+        with self.lock:
+            for key, amount in items:
+                offset = self._offset(key)
+                VALUE.pack_into(self.map, offset,
+                                VALUE.unpack_from(self.map, offset)[0] + amount)
+
+    def set(self, key, value):
+        with self.lock:
+            VALUE.pack_into(self.map, self._offset(key), value)
+
+
+def entries(buffer, used):
+    """yields (key, value offset) of a value file's contents"""
+    position = USED.size
+    while position < used:
+        length = KEY_LENGTH.unpack_from(buffer, position)[0]
+        start = position + KEY_LENGTH.size
+        key = bytes(buffer[start:start + length]).decode()
+        offset = (start + length + 7) & ~7
+        yield key, offset
+        position = offset + VALUE.size
+
+
+def read_values(path):
+    """{series: value} of one process's value file"""
+    with open(path, 'rb') as values:
+        data = values.read()
+    if len(data) < USED.size:
+        return {}
+    used = min(USED.unpack_from(data)[0], len(data))
+    return {key: VALUE.unpack_from(data, offset)[0]
+            for key, offset in entries(data, used)}
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def series(name, **labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{escape(value)}"'
+                                 for key, value in labels.items()) + '}'
+
+
+def metric_of(key):
+    """(metric name, suffix, labels text) of a series"""
+    name, _, labels = key.partition('{')
+    for suffix in ('_bucket', '_sum'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)], suffix, labels.rstrip('}')
+    return name, '', labels.rstrip('}')
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def format_value(value):
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+'''
+Metrics
+    request counters, latency and database-time histograms and pool
+    gauges. Every worker process writes its own value file in
+    `directory`; /metrics adds up the files of all of them. Recording a
+    request costs two clock reads and one locked update of a few values.
+'''
+
+
+class Metrics:
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.pid = None
+        self.file = None
+        self.local = threading.local()
+        self.request_keys = {}
+        self.gauges = defaultdict(float)
+        self.gauge_lock = threading.Lock()
+
+    @classmethod
+    def for_app(cls, app):
+        """value files of this app's database, unless METRICS_DIR is
+        configured"""
+        directory = app.config.get('METRICS_DIR')
+        if directory is None:
+            uri = app.config['SQLALCHEMY_DATABASE_URI'].encode()
+            directory = os.path.join(
+                tempfile.gettempdir(),
+                'trivia-metrics-' + hashlib.sha1(uri).hexdigest()[:12])
+        return cls(directory)
+
+    @property
+    def values(self):
+        # a forked worker writes its own file
+        pid = os.getpid()
+        if pid != self.pid:
+            self.file = ValueFile(os.path.join(self.directory, f'{pid}.db'))
+            if self.pid is not None:
+                self.gauges = defaultdict(float, {
+                    name: self.gauges[name] for name in INHERITED_GAUGES
+                    if name in self.gauges})
+            self.pid = pid
+            for key, value in self.gauges.items():
+                self.file.set(key, value)
+        return self.file
+
+    def init_app(self, app, engine):
+        app.before_request(self.request_started)
+        app.after_request(self.request_finished)
+        event.listen(engine, 'before_cursor_execute', self.query_started)
+        event.listen(engine, 'after_cursor_execute', self.query_finished)
+        pool = engine.pool
+        event.listen(pool, 'connect', lambda *args: self.gauge(
+            'trivia_db_connections_open', 1))
+        event.listen(pool, 'close', lambda *args: self.gauge(
+            'trivia_db_connections_open', -1))
+        event.listen(pool, 'checkout', lambda *args: self.gauge(
+            'trivia_db_connections_in_use', 1))
+        event.listen(pool, 'checkin', lambda *args: self.gauge(
+            'trivia_db_connections_in_use', -1))
+        # QueuePool counts; other pools only report through the events
+        if isinstance(pool, QueuePool):
+            self.gauge('trivia_db_pool_size', pool.size())
+            self.gauge('trivia_db_connections_open',
+                       pool.checkedin() + pool.checkedout())
+            self.gauge('trivia_db_connections_in_use', pool.checkedout())
+
+    def gauge(self, name, amount):
+        # pool events fire on every request thread
+        with self.gauge_lock:
+            values = self.values
+            self.gauges[name] += amount
+            values.set(name, self.gauges[name])
+
+    def request_started(self):
+        self.local.db_time = 0.0
+        self.local.started = time.perf_counter()
+
+    def query_started(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        conn.info['query_started'] = time.perf_counter()
+
+    def query_finished(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        started = conn.info.pop('query_started', None)
+        if started is not None:
+            self.local.db_time = (getattr(self.local, 'db_time', 0.0) +
+                                  time.perf_counter() - started)
+
+    def keys(self, method, route, status):
+        """series names of one (method, route, status), built once"""
+        keys = self.request_keys.get((method, route, status))
+        if keys is None:
+            keys = self.request_keys[method, route, status] = (
+                series('trivia_requests_total', method=method, route=route,
+                       status=status),
+                [series('trivia_request_duration_seconds_bucket',
+                        route=route, le=format_bound(bound))
+                 for bound in BUCKETS + (float('inf'),)],
+                series('trivia_request_duration_seconds_sum', route=route),
+                [series('trivia_request_db_seconds_bucket', route=route,
+                        le=format_bound(bound))
+                 for bound in BUCKETS + (float('inf'),)],
+                series('trivia_request_db_seconds_sum', route=route))
+        return keys
+
+    def request_finished(self, response):
+        started = getattr(self.local, 'started', None)
+        if started is None:
+            return response
+        duration = time.perf_counter() - started
+        db_time = self.local.db_time
+        self.local.started = None
+        rule = request.url_rule
+        total, buckets, duration_sum, db_buckets, db_sum = self.keys(
+            request.method, rule.rule if rule is not None else 'unmatched',
+            response.status_code)
+        self.values.add((
+            (total, 1),
+            (buckets[bisect.bisect_left(BUCKETS, duration)], 1),
+            (duration_sum, duration),
+            (db_buckets[bisect.bisect_left(BUCKETS, db_time)], 1),
+            (db_sum, db_time)))
+        return response
+
+    def collect(self):
+        """
+            Returns:
+                Dict: series -> value summed over the value files of all
+                worker processes; gauges of exited processes are left out
+            """
+        totals = defaultdict(float)
+        for path in glob.glob(os.path.join(self.directory, '*.db')):
+            try:
+                pid = int(os.path.basename(path)[:-3])
+                values = read_values(path)
+            except (ValueError, OSError):
+                continue
+            alive = None
+            for key, value in values.items():
+                if METRICS.get(metric_of(key)[0], ('',))[0] == 'gauge':
+                    if alive is None:
+                        alive = process_alive(pid)
+                    if not alive:
+                        continue
+                totals[key] += value
+        return totals
+
+    def render(self):
+        """all metrics in the Prometheus text format"""
+        by_metric = defaultdict(dict)
+        for key, value in self.collect().items():
+            name, suffix, labels = metric_of(key)
+            by_metric[name][suffix, labels] = value
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            values = by_metric.get(name)
+            if not values:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind != 'histogram':
+                for (_, labels), value in sorted(values.items()):
+                    lines.append(f'{name}'
+                                 f'{"{" + labels + "}" if labels else ""} '
+                                 f'{format_value(value)}')
+                continue
+            lines.extend(histogram_lines(name, values))
+        return '\n'.join(lines) + '\n'
+
+
+def histogram_lines(name, values):
+    """cumulative buckets, sum and count of each labelled histogram"""
+    counts = defaultdict(dict)
+    sums = {}
+    for (suffix, labels), value in values.items():
+        if suffix == '_sum':
+            sums[labels] = value
+        else:
+            labels, _, bound = labels.rpartition(',le=')
+            counts[labels][bound.strip('"')] = value
+    for labels in sorted(counts):
+        cumulative = 0.0
+        for bound in BUCKETS + (float('inf'),):
+            cumulative += counts[labels].get(format_bound(bound), 0)
+            yield (f'{name}_bucket{{{labels},le="{format_bound(bound)}"}} '
+                   f'{format_value(cumulative)}')
+        yield f'{name}_sum{{{labels}}} {format_value(sums.get(labels, 0.0))}'
+        yield f'{name}_count{{{labels}}} {format_value(cumulative)}'
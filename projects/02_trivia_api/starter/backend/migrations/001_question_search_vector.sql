@@ -0,0 +1,15 @@
+-- Full-text search over question and answer text (POST /questions/search).
+-- Apply with: psql trivia < migrations/001_question_search_vector.sql
+
+ALTER TABLE questions ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        to_tsvector('english',
+                    coalesce(question, '') || ' ' || coalesce(answer, ''))
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS questions_search_vector_idx
+    ON questions USING gin (search_vector);
+
+-- Revert with:
+--   DROP INDEX IF EXISTS questions_search_vector_idx;
+--   ALTER TABLE questions DROP COLUMN IF EXISTS search_vector;
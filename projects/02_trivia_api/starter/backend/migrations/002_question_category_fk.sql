@@ -0,0 +1,28 @@
+-- Question.category as an integer foreign key on categories.id, with a
+-- (category, id) index for per-category pages and quiz decks.
+-- Apply with: psql trivia < migrations/002_question_category_fk.sql
+
+ALTER TABLE questions ALTER COLUMN category TYPE integer
+    USING nullif(trim(category::text), '')::integer;
+
+UPDATE questions SET category = NULL
+    WHERE category NOT IN (SELECT id FROM categories);
+
+-- trivia.psql already ships this constraint
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid = 'questions'::regclass AND contype = 'f') THEN
+        ALTER TABLE questions ADD CONSTRAINT category
+            FOREIGN KEY (category) REFERENCES categories (id)
+            ON UPDATE CASCADE ON DELETE SET NULL;
+    END IF;
+END $$;
+
+CREATE INDEX IF NOT EXISTS ix_questions_category_id
+    ON questions (category, id);
+
+-- Revert with:
+--   DROP INDEX IF EXISTS ix_questions_category_id;
+--   ALTER TABLE questions DROP CONSTRAINT IF EXISTS category;
+--   ALTER TABLE questions ALTER COLUMN category TYPE varchar;
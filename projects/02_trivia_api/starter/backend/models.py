@@ -1,7 +1,9 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, BigInteger, LargeBinary, DateTime, ForeignKey, Index, create_engine, inspect
 from flask_sqlalchemy import SQLAlchemy
 import json
+import struct
+from types import SimpleNamespace
 
 database_name = "trivia"
 postgres_username = os.getenv('POSTGRES_USERNAME')  
@@ -27,17 +29,21 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  # per-category pages and quiz decks read a (category, id) range
+  __table_args__ = (Index('ix_questions_category_id', 'category', 'id'),)
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey(
+    'categories.id', name='category', onupdate='CASCADE', ondelete='SET NULL'))
   difficulty = Column(Integer)
 
   def __init__(self, question, answer, category, difficulty):
     self.question = question
     self.answer = answer
-    self.category = category
+    # the frontend posts category ids as strings
+    self.category = int(category) if category not in (None, '') else None
     self.difficulty = difficulty
 
   def insert(self):
@@ -51,6 +57,16 @@ class Question(db.Model):
     db.session.delete(self)
     db.session.commit()
 
+  def previous(self, *fields):
+    # in after_update: the question before this flush, for indexes to
+    # drop, or None when none of `fields` changed
+    state = inspect(self).attrs
+    if not any(state[field].history.has_changes() for field in fields):
+      return None
+    return SimpleNamespace(id=self.id, **{
+      field: (state[field].history.deleted or [getattr(self, field)])[0]
+      for field in ('question', 'answer', 'category', 'difficulty')})
+
   def format(self):
     return {
       'id': self.id,
@@ -77,4 +93,75 @@ class Category(db.Model):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+'''
+QuizSession
+    a pre-shuffled question deck stored as packed 32-bit ids
+'''
+class QuizSession(db.Model):
+  __tablename__ = 'quiz_sessions'
+
+  id = Column(String(32), primary_key=True)
+  category = Column(Integer)
+  deck = Column(LargeBinary, nullable=False)
+  position = Column(Integer, nullable=False, default=0)
+  expires_at = Column(DateTime, nullable=False, index=True)
+
+  def __init__(self, id, category, deck, expires_at):
+    self.id = id
+    self.category = category
+    self.deck = deck
+    self.position = 0
+    self.expires_at = expires_at
+
+  @staticmethod
+  def pack(question_ids):
+    return struct.pack(f'<{len(question_ids)}i', *question_ids)
+
+  def size(self):
+    return len(self.deck) // 4
+
+  def question_id_at(self, position):
+    return struct.unpack_from('<i', self.deck, position * 4)[0]
+
+'''
+QuestionFingerprint
+    hashes of a question's normalized text and MinHash/LSH band
+    signatures (see dedupe.py); questions sharing a hash are candidate
+    duplicates
+'''
+class QuestionFingerprint(db.Model):
+  __tablename__ = 'question_fingerprints'
+  __table_args__ = (Index('ix_question_fingerprints_question_id', 'question_id'),)
+
+  hash = Column(BigInteger, primary_key=True, autoincrement=False)
+  question_id = Column(Integer, ForeignKey(
+    'questions.id', ondelete='CASCADE'), primary_key=True, autoincrement=False)
+
+'''
+LeaderboardEntry
+    a player's best quiz score on one board: a category, or 0 for the
+    global board of best scores in any category
+'''
+class LeaderboardEntry(db.Model):
+  __tablename__ = 'leaderboard'
+  # workers catch up on each other's new bests by time
+  __table_args__ = (Index('ix_leaderboard_achieved_at', 'achieved_at'),)
+
+  category = Column(Integer, primary_key=True, autoincrement=False)
+  player = Column(String(64), primary_key=True)
+  score = Column(Integer, nullable=False)
+  achieved_at = Column(DateTime, nullable=False)
+
+'''
+QuestionCount
+    questions per (category, difficulty), kept current on every write
+    (see stats.py); 0 stands for a missing category or difficulty
+'''
+class QuestionCount(db.Model):
+  __tablename__ = 'question_counts'
+
+  category = Column(Integer, primary_key=True, autoincrement=False)
+  difficulty = Column(Integer, primary_key=True, autoincrement=False)
+  count = Column(Integer, nullable=False)
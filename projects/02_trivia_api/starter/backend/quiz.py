@@ -0,0 +1,360 @@
+import random
+import time
+import uuid
+from array import array
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import event, text
+
+from models import db, Question, QuizSession
+
+ALL_CATEGORIES = 0
+# questions dealt into a quiz session deck and how long an idle one lives
+DECK_SIZE = 50
+SESSION_TTL = timedelta(minutes=30)
+# random draws before falling back to scanning for the unseen ids
+MAX_DRAWS = 32
+# adaptive quizzes move one level at a time within these bounds
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+START_DIFFICULTY = 3
+
+QuizRequest = namedtuple('QuizRequest', 'category legacy previous_questions '
+                         'deck_size adaptive difficulty last_correct')
+
+# statements of the quiz steps below, with :named parameters
+QUESTION_ROW = ('SELECT id, question, answer, category, difficulty '
+                'FROM questions WHERE id = :id')
+BUCKET_ROWS = 'SELECT id, category, difficulty FROM questions'
+EXPIRE_SESSIONS = 'DELETE FROM quiz_sessions WHERE expires_at < :now'
+INSERT_SESSION = (
+    'INSERT INTO quiz_sessions (id, category, deck, position, expires_at) '
+    'VALUES (:id, :category, :deck, 0, :expires_at)')
+SESSION_DECK = ('SELECT deck, position FROM quiz_sessions '
+                'WHERE id = :id AND expires_at >= :now')
+POP_DECK = ('UPDATE quiz_sessions SET position = :next, '
+            'expires_at = :expires_at WHERE id = :id AND position = :position')
+NO_QUESTION = {'success': False, 'question': False}
+
+'''
+IdBucket
+    question ids in a compact array, picked at random in O(1), and the
+    position of each id, so removing one is O(1) as well
+'''
+
+
+class IdBucket:
+
+    def __init__(self):
+        self.ids = array('l')
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, question_id):
+        if question_id not in self.positions:
+            self.positions[question_id] = len(self.ids)
+            self.ids.append(question_id)
+
+    def remove(self, question_id):
+        position = self.positions.pop(question_id, None)
+        if position is None:
+            return
+        # swap with the last id so the array never shifts
+        last = self.ids.pop()
+        if position < len(self.ids):
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def pick(self, seen):
+        """random id that is not in `seen`, or None when all were seen"""
+        size = len(self.ids)
+        if size == 0 or len(seen) >= size and seen.issuperset(self.ids):
+            return None
+        for _ in range(MAX_DRAWS):
+            question_id = self.ids[random.randrange(size)]
+            if question_id not in seen:
+                return question_id
+        # only reached when nearly the whole bucket was already played
+        unseen = [i for i in self.ids if i not in seen]
+        return random.choice(unseen) if unseen else None
+
+
+'''
+QuestionSampler
+    per-category and per-(category, difficulty) id buckets for picking
+    quiz questions without an ORDER BY random() over the table. Buckets
+    follow inserts and deletes made through this process and are reloaded
+    when the "questions" version stamp moves, for writes of other workers
+    (or of the other app), and every `reload_seconds`.
+'''
+
+
+class QuestionSampler:
+
+    def __init__(self, stamps=None, reload_seconds=300):
+        self.stamps = stamps
+        self.reload_seconds = reload_seconds
+        self.buckets = None
+        self.levels = None
+        self.version = None
+        self.loaded_at = 0
+
+    def fill(self, rows, version=None):
+        """rebuilds the buckets from (id, category, difficulty) rows, as
+        of the `version` stamp"""
+        self.buckets = {ALL_CATEGORIES: IdBucket()}
+        self.levels = {}
+        for row in rows:
+            self._add(*row)
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    def _keys(self, category, difficulty):
+        categories = [ALL_CATEGORIES]
+        if category is not None:
+            categories.append(int(category))
+        for category in categories:
+            yield self.buckets, category
+            if difficulty is not None:
+                yield self.levels, (category, int(difficulty))
+
+    def _add(self, question_id, category, difficulty):
+        for buckets, key in self._keys(category, difficulty):
+            buckets.setdefault(key, IdBucket()).add(question_id)
+
+    def reset(self):
+        """reloads on next use, after writes that bypass the ORM"""
+        self.buckets = None
+
+    def add(self, question):
+        if self.buckets is None:
+            return
+        self._add(question.id, question.category, question.difficulty)
+
+    def remove(self, question):
+        if self.buckets is None:
+            return
+        for buckets, key in self._keys(question.category,
+                                       question.difficulty):
+            buckets.get(key, IdBucket()).remove(question.id)
+
+    def current_version(self):
+        if self.stamps is not None:
+            return self.stamps.get('questions')
+
+    def stale(self, version=None):
+        return (self.buckets is None or version != self.version or
+                time.monotonic() - self.loaded_at > self.reload_seconds)
+
+    def bucket(self, category):
+        return self.buckets.get(int(category or ALL_CATEGORIES))
+
+    def level_buckets(self, category, difficulty):
+        """buckets of `category` from `difficulty` outwards, nearest first"""
+        category = int(category or ALL_CATEGORIES)
+        levels = range(MIN_DIFFICULTY, MAX_DIFFICULTY + 1)
+        for level in sorted(levels, key=lambda level: (
+                abs(level - difficulty), level)):
+            bucket = self.levels.get((category, level))
+            if bucket is not None:
+                yield bucket
+
+    def deck(self, category, size):
+        """up to `size` distinct question ids of `category` in random order"""
+        bucket = self.bucket(category)
+        if bucket is None:
+            return []
+        return random.sample(bucket.ids, min(size, len(bucket)))
+
+
+def next_difficulty(difficulty, last_correct):
+    """one level up after a right answer, one down after a wrong one"""
+    if last_correct is not None:
+        difficulty += 1 if last_correct else -1
+    return max(MIN_DIFFICULTY, min(difficulty, MAX_DIFFICULTY))
+
+
+def parse_quiz(body):
+    """the POST /quizzes body
+
+        Raises:
+            ValueError: when the body is malformed
+        """
+    try:
+        quiz_category = body.get('quiz_category') or {}
+        last_correct = body.get('last_correct')
+        quiz = QuizRequest(
+            # category id 0 is "ALL" in the frontend
+            category=int(quiz_category.get('id') or 0),
+            legacy='previous_questions' in body,
+            previous_questions=[
+                int(q) for q in body.get('previous_questions') or []],
+            deck_size=max(1, min(int(body.get('questions', DECK_SIZE)),
+                                 DECK_SIZE)),
+            adaptive=bool(body.get('adaptive')),
+            difficulty=int(body.get('difficulty') or START_DIFFICULTY),
+            last_correct=last_correct)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError('malformed quiz request')
+    if last_correct is not None and not isinstance(last_correct, bool):
+        raise ValueError('last_correct must be a boolean')
+    return quiz
+
+
+'''
+Quiz steps
+    the quiz endpoints as generators of SQL steps, so the Flask app and
+    asgi.py share one implementation and differ only in how they run the
+    statements. Each step yields (kind, SQL with :named parameters,
+    parameters) and is sent back, by kind, every row ("all"), the first
+    row or None ("row") or the number of rows written ("count"). The
+    value a generator returns is the response payload.
+'''
+
+
+def refresh_steps(sampler):
+    # read before the rows, so a write in between moves it again
+    version = sampler.current_version()
+    if sampler.stale(version):
+        sampler.fill((yield 'all', BUCKET_ROWS, {}), version)
+
+
+def draw_steps(bucket, seen):
+    """random question of `bucket` that is not in `seen`, or None"""
+    while True:
+        question_id = bucket.pick(seen)
+        if question_id is None:
+            return None
+        question = yield 'row', QUESTION_ROW, {'id': question_id}
+        if question is not None:
+            return dict(question)
+        # deleted by another worker since the last reload
+        bucket.remove(question_id)
+
+
+def quiz_steps(sampler, quiz):
+    """POST /quizzes: a question, or a new server-side session"""
+    yield from refresh_steps(sampler)
+    if quiz.adaptive:
+        # the client reports how the last answer went, the level moves;
+        # once a level is used up the nearest one with questions left
+        difficulty = next_difficulty(quiz.difficulty, quiz.last_correct)
+        seen = set(quiz.previous_questions)
+        for bucket in sampler.level_buckets(quiz.category, difficulty):
+            question = yield from draw_steps(bucket, seen)
+            if question is not None:
+                return {
+                    'success': True,
+                    'question': question,
+                    'difficulty': difficulty
+                }
+        return NO_QUESTION
+
+    if not quiz.legacy:
+        # server-side session: the client only keeps the session id
+        deck = sampler.deck(quiz.category, quiz.deck_size)
+        session_id, now = uuid.uuid4().hex, datetime.utcnow()
+        yield 'count', EXPIRE_SESSIONS, {'now': now}
+        yield 'count', INSERT_SESSION, {
+            'id': session_id,
+            'category': int(quiz.category or ALL_CATEGORIES),
+            'deck': QuizSession.pack(deck),
+            'expires_at': now + SESSION_TTL}
+        return {
+            'success': True,
+            'session_id': session_id,
+            'total_questions': len(deck)
+        }
+
+    question = None
+    bucket = sampler.bucket(quiz.category)
+    if bucket is not None:
+        question = yield from draw_steps(bucket, set(quiz.previous_questions))
+    if question is None:
+        return NO_QUESTION
+    return {
+        'success': True,
+        'question': question
+    }
+
+
+def next_in_session_steps(session_id):
+    """POST /quizzes/<session id>/next: pops the next question of a quiz
+    session, None when the session is missing or expired"""
+    while True:
+        now = datetime.utcnow()
+        row = yield 'row', SESSION_DECK, {'id': session_id, 'now': now}
+        if row is None:
+            return None
+        session = QuizSession(session_id, None, bytes(row['deck']), now)
+        position = row['position']
+        if position >= session.size():
+            return NO_QUESTION
+        # only one of two concurrent pops can move the position on
+        popped = yield 'count', POP_DECK, {
+            'id': session_id, 'position': position, 'next': position + 1,
+            'expires_at': now + SESSION_TTL}
+        if not popped:
+            continue
+        question = yield 'row', QUESTION_ROW, {
+            'id': session.question_id_at(position)}
+        if question is not None:
+            return {
+                'success': True,
+                'question': dict(question),
+                'remaining': session.size() - position - 1
+            }
+
+
+def run_steps(steps):
+    """runs quiz steps on the Flask-SQLAlchemy session, in one
+    transaction
+
+        Returns:
+            the value `steps` returns
+        """
+    result = None
+    while True:
+        try:
+            kind, sql, params = steps.send(result)
+        except StopIteration as done:
+            db.session.commit()
+            return done.value
+        rows = db.session.execute(text(sql), params)
+        if kind == 'all':
+            result = rows.fetchall()
+        elif kind == 'row':
+            result = rows.first()
+        else:
+            result = rows.rowcount
+
+
+def get_sampler():
+    if has_app_context():
+        return current_app.extensions.get('question_sampler')
+
+
+@event.listens_for(Question, 'after_insert')
+def question_inserted(mapper, connection, question):
+    sampler = get_sampler()
+    if sampler is not None:
+        sampler.add(question)
+
+
+@event.listens_for(Question, 'after_delete')
+def question_deleted(mapper, connection, question):
+    sampler = get_sampler()
+    if sampler is not None:
+        sampler.remove(question)
+
+
+@event.listens_for(Question, 'after_update')
+def question_updated(mapper, connection, question):
+    sampler = get_sampler()
+    previous = question.previous('category', 'difficulty')
+    if sampler is not None and previous is not None:
+        sampler.remove(previous)
+        sampler.add(question)
@@ -0,0 +1,262 @@
+import html
+import math
+import re
+import threading
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect, select, text
+
+from models import db, Question
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+# what html.escape replaces, in the order it does, as SQL literals
+HTML_ESCAPES = (("'&'", "'&amp;'"), ("'<'", "'&lt;'"), ("'>'", "'&gt;'"),
+                ("'\"'", "'&quot;'"), ("''''", "'&#x27;'"))
+
+
+def sql_html_escape(column):
+    """SQL escaping `column` like html.escape, so text a user submitted
+    is never returned as markup"""
+    for char, entity in HTML_ESCAPES:
+        column = f'replace({column}, {char}, {entity})'
+    return column
+
+
+'''
+PostgresSearch
+    ranked full-text search over questions.search_vector (see
+    migrations/001_question_search_vector.sql). Filters, ranking, snippets
+    and the total all come from one query.
+'''
+
+
+class PostgresSearch:
+    VECTOR = ("to_tsvector('english', coalesce(question, '') || ' ' || "
+              "coalesce(answer, ''))")
+    # highlights are HTML: the text is escaped before ts_headline adds
+    # its <b> tags
+    ESCAPED_QUESTION = sql_html_escape('question')
+
+    def __init__(self):
+        self.vector = None
+
+    def _vector(self):
+        # without the migration the same vector is computed per row
+        if self.vector is None:
+            columns = {c['name'] for c in inspect(db.engine).get_columns(
+                'questions')}
+            self.vector = ('search_vector' if 'search_vector' in columns
+                           else self.VECTOR)
+        return self.vector
+
+    def search(self, term, category=None, difficulty=None, page=1,
+               per_page=10):
+        self._vector()
+        sql, params = self.statement(term, category, difficulty, page,
+                                     per_page)
+        rows = db.session.execute(text(sql), params).fetchall()
+        if rows:
+            total = rows[0].total
+        elif page > 1:
+            total = self.search(term, category, difficulty, 1, 1)[1]
+        else:
+            total = 0
+        return [self.format(row) for row in rows], total
+
+    @staticmethod
+    def format(row):
+        return {
+            'id': row['id'],
+            'question': row['question'],
+            'answer': row['answer'],
+            'category': row['category'],
+            'difficulty': row['difficulty'],
+            'highlight': row['highlight'],
+        }
+
+    def statement(self, term, category, difficulty, page, per_page):
+        """
+            Returns:
+                Tuple: (SQL with :named parameters, parameters)
+            """
+        params = {'limit': per_page, 'offset': (page - 1) * per_page}
+        where = []
+        if category is not None:
+            where.append('category = :category')
+            params['category'] = category
+        if difficulty is not None:
+            where.append('difficulty = :difficulty')
+            params['difficulty'] = difficulty
+        if term:
+            params['term'] = term
+            where.append(f'{self.vector} @@ query')
+            sql = f'''
+                SELECT id, question, answer, category, difficulty,
+                       ts_headline('english', {self.ESCAPED_QUESTION},
+                                   query) AS highlight,
+                       count(*) OVER () AS total
+                FROM questions, websearch_to_tsquery('english', :term) query
+                WHERE {' AND '.join(where)}
+                ORDER BY ts_rank({self.vector}, query) DESC, id'''
+        else:
+            sql = f'''
+                SELECT id, question, answer, category, difficulty,
+                       {self.ESCAPED_QUESTION} AS highlight,
+                       count(*) OVER () AS total
+                FROM questions
+                {'WHERE ' + ' AND '.join(where) if where else ''}
+                ORDER BY id'''
+        return sql + ' LIMIT :limit OFFSET :offset', params
+
+    def reset(self):
+        pass
+
+    def add(self, question):
+        pass
+
+    def remove(self, question):
+        pass
+
+
+'''
+InvertedIndexSearch
+    in-memory fallback for databases without full-text search (SQLite):
+    token -> {question id: term frequency}, ranked by tf-idf. Follows
+    inserts and deletes made through this process.
+'''
+
+
+class InvertedIndexSearch:
+
+    def __init__(self):
+        self.postings = None
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tokens(value):
+        return TOKEN.findall((value or '').lower())
+
+    def load(self):
+        self.postings = {}
+        self.documents = {}
+        for row in db.session.execute(select([
+                Question.id, Question.question, Question.answer,
+                Question.category, Question.difficulty])):
+            self._index(row.id, row.question, row.answer, row.category,
+                        row.difficulty)
+
+    def _index(self, id, question, answer, category, difficulty):
+        tokens = self.tokens(question) + self.tokens(answer)
+        self.documents[id] = (question, answer, category, difficulty,
+                              len(tokens))
+        for token in tokens:
+            postings = self.postings.setdefault(token, {})
+            postings[id] = postings.get(id, 0) + 1
+
+    def reset(self):
+        """rebuilds on next search, after writes that bypass the ORM"""
+        with self.lock:
+            self.postings = None
+            self.documents = {}
+
+    def add(self, question):
+        with self.lock:
+            if self.postings is not None:
+                self._index(question.id, question.question, question.answer,
+                            question.category, question.difficulty)
+
+    def remove(self, question):
+        with self.lock:
+            if self.postings is None or question.id not in self.documents:
+                return
+            self.documents.pop(question.id)
+            for token in set(self.tokens(question.question) +
+                             self.tokens(question.answer)):
+                self.postings.get(token, {}).pop(question.id, None)
+
+    @staticmethod
+    def highlight(value, terms):
+        """`value` as HTML, escaped, with the words in `terms` in <b> tags"""
+        value = value or ''
+        parts, end = [], 0
+        for match in TOKEN.finditer(value):
+            if match.group(0).lower() in terms:
+                parts.append(html.escape(value[end:match.start()]))
+                parts.append(f'<b>{html.escape(match.group(0))}</b>')
+                end = match.end()
+        parts.append(html.escape(value[end:]))
+        return ''.join(parts)
+
+    def search(self, term, category=None, difficulty=None, page=1,
+               per_page=10):
+        with self.lock:
+            if self.postings is None:
+                self.load()
+            terms = set(self.tokens(term))
+            if terms:
+                # every term must match, rarest first to keep sets small
+                postings = sorted((self.postings.get(t, {}) for t in terms),
+                                  key=len)
+                matches = set(postings[0])
+                for posting in postings[1:]:
+                    matches &= posting.keys()
+                ranks = {id: sum(
+                    p[id] / self.documents[id][4] *
+                    math.log(1 + len(self.documents) / len(p))
+                    for p in postings) for id in matches}
+            else:
+                ranks = dict.fromkeys(self.documents, 0)
+            hits = [id for id in ranks
+                    if (category is None or
+                        self.documents[id][2] == category) and
+                    (difficulty is None or
+                     self.documents[id][3] == difficulty)]
+            hits.sort(key=lambda id: (-ranks[id], id))
+            start = (page - 1) * per_page
+            questions = []
+            for id in hits[start:start + per_page]:
+                question, answer, cat, diff, _ = self.documents[id]
+                questions.append({
+                    'id': id,
+                    'question': question,
+                    'answer': answer,
+                    'category': cat,
+                    'difficulty': diff,
+                    'highlight': self.highlight(question, terms),
+                })
+            return questions, len(hits)
+
+
+def create_search(engine):
+    if engine.dialect.name == 'postgresql':
+        return PostgresSearch()
+    return InvertedIndexSearch()
+
+
+def get_search():
+    if has_app_context():
+        return current_app.extensions.get('question_search')
+
+
+@event.listens_for(Question, 'after_insert')
+def question_inserted(mapper, connection, question):
+    search = get_search()
+    if search is not None:
+        search.add(question)
+
+
+@event.listens_for(Question, 'after_delete')
+def question_deleted(mapper, connection, question):
+    search = get_search()
+    if search is not None:
+        search.remove(question)
+
+
+@event.listens_for(Question, 'after_update')
+def question_updated(mapper, connection, question):
+    search = get_search()
+    previous = question.previous('question', 'answer', 'category',
+                                 'difficulty')
+    if search is not None and previous is not None:
+        search.remove(previous)
+        search.add(question)
@@ -0,0 +1,364 @@
+import hashlib
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+from sqlalchemy import event, select
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # optional, pip install numpy scipy
+    np = sparse = None
+
+from models import db, Question
+from dedupe import normalize
+
+# questions returned by default and at most
+TOP_K = 10
+MAX_K = 50
+# rows inserted since the last merge live in a small matrix of their own,
+# so an insert never copies the whole index
+MERGE_ROWS = 1024
+# rows read per query when building or catching up
+BATCH_SIZE = 10000
+STOP_WORDS = frozenset(
+    'a an and are as at be by did does for from has have how in is it its '
+    'of on or the this that to was were what when where which who whom '
+    'whose why with'.split())
+
+
+def terms(question, answer):
+    """accent- and case-folded words of a question and its answer"""
+    return [term for term in normalize(f'{question or ""} {answer or ""}')
+            .split() if term not in STOP_WORDS]
+
+
+'''
+SimilarityIndex
+    TF-IDF vectors of every question (sublinear term frequency, smoothed
+    idf, L2-normalized rows) in a SciPy CSR matrix, so the cosine
+    similarity of one question to all others is a single sparse
+    matrix-vector product. The idf weights are fixed when the index is
+    built: questions added later are weighted with them, terms first seen
+    then get the weight of a term found once. Rebuild it from time to
+    time with `flask similar-index`.
+'''
+
+
+class SimilarityIndex:
+
+    def __init__(self):
+        self.vocabulary = {}
+        self.idf = []
+        self.documents = 0
+        self.main = None
+        self.main_ids = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_matrix = None
+        self.rows = {}
+        self.max_id = 0
+
+    @classmethod
+    def build(cls, rows):
+        """an index of (id, question, answer) rows"""
+        index = cls()
+        documents = [(question_id, Counter(terms(question, answer)))
+                     for question_id, question, answer in rows]
+        frequencies = Counter(term for _, counts in documents
+                              for term in counts)
+        index.documents = len(documents)
+        for term, frequency in frequencies.items():
+            index.vocabulary[term] = len(index.idf)
+            index.idf.append(index.weight(frequency))
+        vectors = [(question_id, index.vector(counts))
+                   for question_id, counts in documents]
+        index.main, index.main_ids = index.matrix(vectors)
+        index.rows = {question_id: row for row, (question_id, _)
+                      in enumerate(vectors)}
+        index.max_id = max(index.rows, default=0)
+        return index
+
+    def weight(self, frequency):
+        return math.log((1 + self.documents) / (1 + frequency)) + 1
+
+    def vector(self, counts, grow=False):
+        """
+            Returns:
+                Tuple: (columns, L2-normalized weights) of a document's
+                term counts; unknown terms are added with `grow`, else
+                left out
+            """
+        columns, weights = [], []
+        for term, count in counts.items():
+            column = self.vocabulary.get(term)
+            if column is None:
+                if not grow:
+                    continue
+                column = self.vocabulary[term] = len(self.idf)
+                self.idf.append(self.weight(1))
+            columns.append(column)
+            weights.append((1 + math.log(count)) * self.idf[column])
+        norm = math.sqrt(sum(weight * weight for weight in weights)) or 1.0
+        return columns, [weight / norm for weight in weights]
+
+    def matrix(self, vectors):
+        """CSR matrix and id array of (id, (columns, weights)) rows"""
+        indptr = np.zeros(len(vectors) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(columns) for _, (columns, _)
+                                in vectors])
+        indices = np.fromiter(
+            (column for _, (columns, _) in vectors for column in columns),
+            dtype=np.int32, count=int(indptr[-1]))
+        data = np.fromiter(
+            (weight for _, (_, weights) in vectors for weight in weights),
+            dtype=np.float32, count=int(indptr[-1]))
+        ids = np.fromiter((question_id for question_id, _ in vectors),
+                          dtype=np.int64, count=len(vectors))
+        return sparse.csr_matrix((data, indices, indptr),
+                                 shape=(len(vectors), len(self.idf))), ids
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, question_id, question, answer):
+        self.remove(question_id)
+        columns, weights = self.vector(Counter(terms(question, answer)),
+                                       grow=True)
+        self.rows[question_id] = -1 - len(self.pending)
+        self.pending.append((question_id, (columns, weights)))
+        self.pending_matrix = None
+        self.max_id = max(self.max_id, question_id)
+        if len(self.pending) >= MERGE_ROWS:
+            self.merge()
+
+    def remove(self, question_id):
+        row = self.rows.pop(question_id, None)
+        if row is None:
+            return
+        if row >= 0:
+            # zeroed in place, dropped at the next build
+            start, end = self.main.indptr[row:row + 2]
+            self.main.data[start:end] = 0
+        else:
+            self.pending[-1 - row] = (question_id, ([], []))
+            self.pending_matrix = None
+
+    def merge(self):
+        """moves the pending rows into the main matrix"""
+        if not self.pending:
+            return
+        added, ids = self.matrix(self.pending)
+        main = self.main
+        main.resize(main.shape[0], len(self.idf))
+        self.main = sparse.vstack([main, added], format='csr')
+        offset = len(self.main_ids)
+        self.main_ids = np.concatenate([self.main_ids, ids])
+        for row, (question_id, _) in enumerate(self.pending):
+            if self.rows.get(question_id) == -1 - row:
+                self.rows[question_id] = offset + row
+        self.pending, self.pending_matrix = [], None
+
+    def row_vector(self, question_id):
+        """dense TF-IDF vector of an indexed question, or None"""
+        row = self.rows.get(question_id)
+        if row is None:
+            return None
+        dense = np.zeros(len(self.idf), dtype=np.float32)
+        if row >= 0:
+            start, end = self.main.indptr[row:row + 2]
+            dense[self.main.indices[start:end]] = self.main.data[start:end]
+        else:
+            columns, weights = self.pending[-1 - row][1]
+            dense[columns] = weights
+        return dense
+
+    def similar(self, question_id, k=TOP_K):
+        """
+            Returns:
+                List: (question id, cosine similarity) of the `k` most
+                similar other questions, most similar first, or None when
+                the question is not indexed
+            """
+        query = self.row_vector(question_id)
+        if query is None:
+            return None
+        scores = self.main.dot(query[:self.main.shape[1]])
+        ids = self.main_ids
+        if self.pending:
+            if self.pending_matrix is None:
+                self.pending_matrix = self.matrix(self.pending)
+            matrix, pending_ids = self.pending_matrix
+            scores = np.concatenate([scores, matrix.dot(query)])
+            ids = np.concatenate([ids, pending_ids])
+        scores[ids == question_id] = 0
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(ids[row]), round(float(scores[row]), 4))
+                for row in top if scores[row] > 0]
+
+    def save(self, path):
+        self.merge()
+        terms_by_column = [''] * len(self.idf)
+        for term, column in self.vocabulary.items():
+            terms_by_column[column] = term
+        # written aside and moved in, so readers never see half a file
+        partial = f'{path}.{os.getpid()}.npz'
+        np.savez(partial, data=self.main.data, indices=self.main.indices,
+                 indptr=self.main.indptr, ids=self.main_ids,
+                 idf=np.array(self.idf), terms=np.array(terms_by_column),
+                 documents=self.documents)
+        os.replace(partial, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as saved:
+            index.idf = saved['idf'].tolist()
+            index.vocabulary = {term: column for column, term
+                                in enumerate(saved['terms'].tolist())}
+            index.documents = int(saved['documents'])
+            index.main_ids = saved['ids']
+            index.main = sparse.csr_matrix(
+                (saved['data'], saved['indices'], saved['indptr']),
+                shape=(len(index.main_ids), len(index.idf)))
+        index.rows = {int(question_id): row for row, question_id
+                      in enumerate(index.main_ids)}
+        index.max_id = max(index.rows, default=0)
+        return index
+
+
+def question_rows(conn, after=0, batch_size=BATCH_SIZE):
+    """yields (id, question, answer) of the questions after id `after`"""
+    while True:
+        rows = conn.execute(
+            select([Question.id, Question.question, Question.answer])
+            .where(Question.id > after).order_by(Question.id)
+            .limit(batch_size)).fetchall()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        after = rows[-1][0]
+
+
+'''
+SimilarQuestions
+    the SimilarityIndex of one worker process: loaded from the file
+    `flask similar-index` writes (or built from the table when there is
+    none), kept current with this worker's inserts and deletes, and
+    caught up with questions other workers added when the "questions"
+    version stamp moves. A newer file replaces it.
+'''
+
+
+class SimilarQuestions:
+
+    def __init__(self, stamps, path):
+        self.stamps = stamps
+        self.path = path
+        self.index = None
+        self.version = None
+        self.loaded_mtime = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def available():
+        return np is not None
+
+    @classmethod
+    def for_app(cls, app, stamps):
+        """index file of this app's database, unless SIMILARITY_INDEX_PATH
+        is configured"""
+        path = app.config.get('SIMILARITY_INDEX_PATH')
+        if path is None:
+            uri = app.config['SQLALCHEMY_DATABASE_URI'].encode()
+            path = os.path.join(tempfile.gettempdir(), 'trivia-similar-' +
+                                hashlib.sha1(uri).hexdigest()[:12] + '.npz')
+        return cls(stamps, path)
+
+    def reset(self):
+        with self.lock:
+            self.index = None
+
+    def mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _refresh(self):
+        version = self.stamps.get('questions')
+        mtime = self.mtime()
+        if self.index is None or mtime != self.loaded_mtime:
+            if mtime is not None:
+                self.index = SimilarityIndex.load(self.path)
+            else:
+                self.index = SimilarityIndex.build(question_rows(db.session))
+            self.loaded_mtime = mtime
+            self.version = None
+        if version != self.version:
+            for row in question_rows(db.session, self.index.max_id):
+                self.index.add(*row)
+            self.version = version
+
+    def similar(self, question_id, k=TOP_K):
+        with self.lock:
+            self._refresh()
+            return self.index.similar(question_id, k)
+
+    def add(self, question):
+        with self.lock:
+            if self.index is not None:
+                self.index.add(question.id, question.question,
+                               question.answer)
+
+    def remove(self, question):
+        with self.lock:
+            if self.index is not None:
+                self.index.remove(question.id)
+
+
+@click.command('similar-index')
+@with_appcontext
+def similar_index_command():
+    """Build the TF-IDF index of similar questions and save it for the
+    workers, which load it on their next query."""
+    if not SimilarQuestions.available():
+        raise click.ClickException('needs numpy and scipy, '
+                                   'pip install numpy scipy')
+    similar = current_app.extensions['similar_questions']
+    started = time.monotonic()
+    index = SimilarityIndex.build(question_rows(db.session))
+    index.save(similar.path)
+    click.echo(f'{len(index)} questions, {len(index.idf)} terms, '
+               f'{index.main.nnz} weights in '
+               f'{time.monotonic() - started:.1f} s -> {similar.path}',
+               err=True)
+
+
+def get_similar():
+    if has_app_context():
+        return current_app.extensions.get('similar_questions')
+
+
+@event.listens_for(Question, 'after_insert')
+def question_inserted(mapper, connection, question):
+    similar = get_similar()
+    if similar is not None:
+        similar.add(question)
+
+
+@event.listens_for(Question, 'after_delete')
+def question_deleted(mapper, connection, question):
+    similar = get_similar()
+    if similar is not None:
+        similar.remove(question)
@@ -0,0 +1,168 @@
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, inspect, select, text
+from sqlalchemy.engine import Connection
+
+from models import db, Question, QuestionCount
+
+# count key of questions without a category or a difficulty
+MISSING = 0
+# adds :delta to one count, creating its row on the first question; the
+# same statement runs on PostgreSQL and SQLite 3.24+
+ADD_COUNT = (
+    'INSERT INTO question_counts (category, difficulty, count) '
+    'VALUES (:category, :difficulty, :delta) '
+    'ON CONFLICT (category, difficulty) '
+    'DO UPDATE SET count = question_counts.count + excluded.count')
+
+
+def count_key(category, difficulty):
+    return (MISSING if category is None else int(category),
+            MISSING if difficulty is None else int(difficulty))
+
+
+def add_counts(conn, deltas):
+    """applies {(category, difficulty): delta} to the counts table"""
+    # a fixed order, so concurrent writers lock the rows alike
+    params = [{'category': category, 'difficulty': difficulty,
+               'delta': delta}
+              for (category, difficulty), delta in sorted(deltas.items())
+              if delta]
+    if params:
+        conn.execute(text(ADD_COUNT), params)
+
+
+def actual_counts(conn):
+    """{(category, difficulty): questions}, counted over the whole table"""
+    category = func.coalesce(Question.category, MISSING)
+    difficulty = func.coalesce(Question.difficulty, MISSING)
+    return {(row[0], row[1]): row[2] for row in conn.execute(
+        select([category, difficulty, func.count()])
+        .group_by(category, difficulty))}
+
+
+def reconcile(conn):
+    """recounts the questions and corrects the counts table
+
+        On PostgreSQL the counts are locked for the recount, so writes
+        that land meanwhile wait and are added on top of it.
+
+        Returns:
+            List: (category, difficulty, stored, actual) of every count
+            that was off
+        """
+    table = QuestionCount.__table__
+    bind = conn if isinstance(conn, Connection) else conn.get_bind()
+    if bind.dialect.name == 'postgresql':
+        conn.execute('LOCK TABLE question_counts IN EXCLUSIVE MODE')
+    stored = {(row.category, row.difficulty): row.count
+              for row in conn.execute(select([table]))}
+    actual = actual_counts(conn)
+    drift = [(category, difficulty, stored.get((category, difficulty), 0),
+              actual.get((category, difficulty), 0))
+             for category, difficulty in sorted(set(stored) | set(actual))
+             # rows left at 0 by deletes are harmless
+             if stored.get((category, difficulty), 0) !=
+             actual.get((category, difficulty), 0)]
+    for category, difficulty, _, count in drift:
+        conn.execute(table.delete().where(
+            (table.c.category == category) &
+            (table.c.difficulty == difficulty)))
+        if count:
+            conn.execute(table.insert(), {'category': category,
+                                          'difficulty': difficulty,
+                                          'count': count})
+    return drift
+
+
+def ensure_counts(conn):
+    """counts the question bank once, when the counts table is new"""
+    if conn.execute(select([QuestionCount.category]).limit(1)).first():
+        return
+    if conn.execute(select([Question.id]).limit(1)).first():
+        reconcile(conn)
+
+
+def question_stats(counts, categories):
+    """
+        Args:
+            counts : {(category, difficulty): questions}
+            categories : {id: type} of every category
+
+        Returns:
+            Dict: totals overall, per difficulty and per category, and
+            each category's questions per difficulty
+        """
+    per_category = {category_id: {'type': category_type, 'total': 0,
+                                  'difficulties': {}}
+                    for category_id, category_type in categories.items()}
+    difficulties = defaultdict(int)
+    uncategorized = 0
+    for (category, difficulty), count in sorted(counts.items()):
+        if count <= 0:
+            continue
+        difficulties[difficulty] += count
+        entry = per_category.get(category)
+        if entry is None:
+            uncategorized += count
+            continue
+        entry['total'] += count
+        entry['difficulties'][difficulty] = count
+    return {
+        'total_questions': sum(difficulties.values()),
+        'difficulties': dict(difficulties),
+        'categories': per_category,
+        'uncategorized': uncategorized,
+    }
+
+
+@click.command('reconcile-stats')
+@with_appcontext
+def reconcile_command():
+    """Recount questions per category and difficulty and fix the counts
+    table; run it from cron to catch writes made outside the app."""
+    with db.engine.begin() as conn:
+        drift = reconcile(conn)
+    for category, difficulty, stored, actual in drift:
+        click.echo(f'category {category} difficulty {difficulty}: '
+                   f'{stored} -> {actual}')
+    if drift:
+        # /stats pages are cached under the questions stamp
+        current_app.extensions['version_stamps'].bump('questions')
+    click.echo(f'{len(drift)} counts corrected', err=True)
+
+
+'''
+Question writes through the ORM (Question.insert(), update() and
+delete()) move the counts in the same transaction. Bulk imports, which
+use Core inserts, call add_counts themselves.
+'''
+
+
+@event.listens_for(Question, 'after_insert')
+def question_inserted(mapper, connection, question):
+    add_counts(connection, {
+        count_key(question.category, question.difficulty): 1})
+
+
+@event.listens_for(Question, 'after_update')
+def question_updated(mapper, connection, question):
+    state = inspect(question).attrs
+    category, difficulty = state.category.history, state.difficulty.history
+    if not (category.has_changes() or difficulty.has_changes()):
+        return
+    old = count_key(
+        (category.deleted or [question.category])[0],
+        (difficulty.deleted or [question.difficulty])[0])
+    new = count_key(question.category, question.difficulty)
+    if old != new:
+        add_counts(connection, {old: -1, new: 1})
+
+
+@event.listens_for(Question, 'after_delete')
+def question_deleted(mapper, connection, question):
+    add_counts(connection, {
+        count_key(question.category, question.difficulty): -1})